@@ -3,82 +3,91 @@ from tkinter import filedialog, messagebox, ttk
 import json
 import os
 import sys
-import subprocess
 import threading
 
+if getattr(sys, 'frozen', False):
+    application_path = sys._MEIPASS
+else:
+    application_path = os.path.dirname(os.path.abspath(__file__))
+
+# The converter is imported and run in-process, so no Python interpreter is needed next to the frozen build
+sys.path.insert(0, os.path.join(application_path, 'script'))
+import mytag_converter
+
 class MusicTagsApp:
     def __init__(self, root):
         self.root = root
         self.root.title("MyTag Extractor and Converter")
-        self.root.geometry("600x250")  # Shrink the window size
-        
-        if getattr(sys, 'frozen', False):
-            application_path = sys._MEIPASS
-        elif __file__:
-            application_path = os.path.dirname(__file__)
+        self.root.geometry("600x330")  # Shrink the window size
         
         self.root.iconbitmap(default=os.path.join(application_path, 'images/rekordbox.ico'))
 
         self.config_file = 'config.json'  # Default config file
 
+        # State of the converter run in the background thread
+        self.run_thread = None
+        self.cancel_event = None
+        self.watching = False
+        self.closing = False
+        self.latest_progress = None
+        self.progress_scheduled = False
+
         # Load config data
         self.load_config()
 
         # Create widgets
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def load_config(self):
-        """Load the configuration from the JSON file."""
-        if os.path.exists(self.config_file):
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
-        else:
-            self.config = {
-                "use_rekordbox_xml": False,
-                "rekordbox_db_path": "/path/to/exported/rekordbox.xml",
-                "music_directory": "/path/to/your/music/directory",
-                "mytag_db_file": "MyTags.xml",
-                "tag_delimiter": " / "
-            }
+        """Load and validate the configuration from the JSON file."""
+        new_config = not os.path.exists(self.config_file)
+        try:
+            self.config_store = mytag_converter.ConfigStore.open(self.config_file)
+        except mytag_converter.ConfigError as e:
+            # Keep the broken file so nothing in it is lost, and start over from the defaults
+            os.replace(self.config_file, self.config_file + '.bak')
+            messagebox.showwarning("Invalid Config", f"{e}\n\nThe file was moved to {self.config_file}.bak and the default settings are used instead.")
+            self.config_store = mytag_converter.ConfigStore.open(self.config_file)
+            new_config = True
+        self.config = self.config_store.data
+        if new_config:
             self.add_default_categories()
             
     def add_default_categories(self):
         """Add the default categories if none exist."""
-        default_categories = {
-                "Genre": {
-                "tags": ["House", "Trap", "Dubstep", "Disco", "Drum and Bass"],
-                "rekordbox_field": "Genre",
-                "metadata_field": "GENRE"
-            },
-            "Components": {
-                "tags": ["Synth", "Piano", "Kick", "Hi Hat"],
-                "rekordbox_field": "Composer",
-                "metadata_field": "COMPOSER"
-            },
-            "Situation": {
-                "tags": ["Warm Up", "Building", "Peak Time", "After Hours", "Lounge", "House Party" ],
-                "rekordbox_field": "Label",
-                "metadata_field": "LABEL"
-            },
-            "Mood": {
-                "tags": ["Happy", "Melancholy", "Emotional", "Hype", "Angry"],
-                "rekordbox_field": "Comments",
-                "metadata_field": "COMMENT"
-            }
-        }
-        
-        self.config["categories"] = default_categories
+        self.config["categories"] = json.loads(json.dumps(mytag_converter.DEFAULT_CATEGORIES))
         self.save_config()
 
     def save_config(self):
-        """Save the current configuration to the JSON file."""
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, indent=4)
+        """Queue the current configuration to be written to the JSON file once editing pauses."""
+        self.config_store.save()
+
+    def on_close(self):
+        """Stop the running script or watch, then write any pending config change and close the window."""
+        if self.run_thread is not None and self.run_thread.is_alive():
+            if self.closing:
+                return
+            self.closing = True
+            self.cancel_run()
+            self.status_var.set("Closing after the current file...")
+        self._close_when_stopped()
+
+    def _close_when_stopped(self):
+        """Close the window once the run thread has stopped."""
+        # Destroying the window kills the run thread, possibly while it saves a file, so wait for it instead of joining
+        # here (the thread hands its progress to the main loop, which must keep running)
+        if self.run_thread is not None and self.run_thread.is_alive():
+            self.root.after(100, self._close_when_stopped)
+            return
+        self.config_store.close()
+        self.root.destroy()
 
     def create_widgets(self):
         """Create the GUI widgets."""
         self.create_file_selectors()
         self.create_buttons()
+        self.create_progress()
 
     def create_file_selectors(self):
         """Create the file selectors for Rekordbox XML, music directory, and output XML."""
@@ -87,7 +96,7 @@ class MusicTagsApp:
         self.rekordbox_label = tk.Label(self.root, text="Rekordbox XML Path:")
         self.rekordbox_label.grid(row=0, column=0, sticky="w", padx=10, pady=5)
         self.rekordbox_path = tk.Entry(self.root, width=50)
-        self.rekordbox_path.insert(0, self.config.get("rekordbox_db_path", ""))
+        self.rekordbox_path.insert(0, os.pathsep.join(mytag_converter.collection_paths(self.config.get("rekordbox_db_path", ""))))
         self.rekordbox_path.grid(row=0, column=1, padx=10, pady=5)
         self.rekordbox_path.bind("<KeyRelease>", self.on_file_path_change)
 
@@ -124,14 +133,28 @@ class MusicTagsApp:
         self.tag_delimiter.grid(row=3, column=1, sticky='w', padx=10, pady=5)
         self.tag_delimiter.bind("<KeyRelease>", self.on_file_path_change)
 
+        # Checkboxes
+        checkbox_frame = tk.Frame(self.root)
+        checkbox_frame.grid(row=4, column=0, columnspan=3, padx=10, pady=5)
+
         # Use Rekordbox XML Checkbox
         self.use_rekordbox_var = tk.BooleanVar(value=self.config.get("use_rekordbox_xml", False))
-        self.use_rekordbox_checkbox = tk.Checkbutton(self.root, text="Use Rekordbox XML", variable=self.use_rekordbox_var, command=self.on_use_rekordbox_change)
-        self.use_rekordbox_checkbox.grid(row=4, column=0, columnspan=3, padx=10, pady=5)
+        self.use_rekordbox_checkbox = tk.Checkbutton(checkbox_frame, text="Use Rekordbox XML", variable=self.use_rekordbox_var, command=self.on_use_rekordbox_change)
+        self.use_rekordbox_checkbox.grid(row=0, column=0, padx=10)
+
+        # Force Full Rescan Checkbox
+        self.force_rescan_var = tk.BooleanVar(value=self.config.get("force_rescan", False))
+        self.force_rescan_checkbox = tk.Checkbutton(checkbox_frame, text="Force Full Rescan", variable=self.force_rescan_var, command=self.on_force_rescan_change)
+        self.force_rescan_checkbox.grid(row=0, column=1, padx=10)
+
+        # Profile Run Checkbox
+        self.profile_var = tk.BooleanVar(value=self.config.get("profile", False))
+        self.profile_checkbox = tk.Checkbutton(checkbox_frame, text="Profile Run", variable=self.profile_var, command=self.on_profile_change)
+        self.profile_checkbox.grid(row=0, column=2, padx=10)
 
     def on_file_path_change(self, event):
         """Update the corresponding value in config when a file path is modified."""
-        self.config["rekordbox_db_path"] = self.rekordbox_path.get()
+        self.config["rekordbox_db_path"] = self.get_rekordbox_paths()
         self.config["music_directory"] = self.music_dir_path.get()
         self.config["mytag_db_file"] = self.output_xml_path.get()
         self.config["tag_delimiter"] = self.tag_delimiter.get()
@@ -142,8 +165,18 @@ class MusicTagsApp:
         self.config["use_rekordbox_xml"] = self.use_rekordbox_var.get()
         self.save_config()
 
+    def on_force_rescan_change(self):
+        """Update the 'force_rescan' value in the config when the checkbox is toggled."""
+        self.config["force_rescan"] = self.force_rescan_var.get()
+        self.save_config()
+
+    def on_profile_change(self):
+        """Update the 'profile' value in the config when the checkbox is toggled."""
+        self.config["profile"] = self.profile_var.get()
+        self.save_config()
+
     def create_buttons(self):
-        """Create the 'MyTags' and 'Run Script' buttons side by side."""
+        """Create the 'MyTags', 'Run Script', 'Watch' and 'Cancel' buttons side by side."""
         button_frame = tk.Frame(self.root)
         button_frame.grid(row=5, column=0, columnspan=3, pady=20)
 
@@ -155,14 +188,36 @@ class MusicTagsApp:
         self.run_button = tk.Button(button_frame, text="Run Script", command=self.run_script)
         self.run_button.grid(row=0, column=1, padx=10, pady=5)
 
+        # Watch Button
+        self.watch_button = tk.Button(button_frame, text="Watch", command=self.toggle_watch)
+        self.watch_button.grid(row=0, column=2, padx=10, pady=5)
+
+        # Cancel Button
+        self.cancel_button = tk.Button(button_frame, text="Cancel", command=self.cancel_run, state=tk.DISABLED)
+        self.cancel_button.grid(row=0, column=3, padx=10, pady=5)
+
+    def create_progress(self):
+        """Create the progress bar and status line shown while the script runs."""
+        self.progress_bar = ttk.Progressbar(self.root, orient=tk.HORIZONTAL, length=560, mode='determinate')
+        self.progress_bar.grid(row=6, column=0, columnspan=3, padx=10, pady=5)
+
+        self.status_var = tk.StringVar(value="Ready")
+        self.status_label = tk.Label(self.root, textvariable=self.status_var, anchor="w", width=75)
+        self.status_label.grid(row=7, column=0, columnspan=3, sticky="w", padx=10)
+
     def browse_rekordbox(self):
-        """Browse for the Rekordbox XML file."""
-        file_path = filedialog.askopenfilename(filetypes=[("XML files", "*.xml")])
-        if file_path:
+        """Browse for one or more Rekordbox XML files."""
+        file_paths = filedialog.askopenfilenames(filetypes=[("XML files", "*.xml")])
+        if file_paths:
             self.rekordbox_path.delete(0, tk.END)
-            self.rekordbox_path.insert(0, file_path)
+            self.rekordbox_path.insert(0, os.pathsep.join(file_paths))
             self.on_file_path_change(None)  # Trigger config update
 
+    def get_rekordbox_paths(self):
+        """Return the Rekordbox XML path, or a list of paths if several are entered separated by os.pathsep."""
+        paths = [path.strip() for path in self.rekordbox_path.get().split(os.pathsep) if path.strip()]
+        return paths if len(paths) > 1 else self.rekordbox_path.get()
+
     def browse_music_dir(self):
         """Browse for the music directory."""
         dir_path = filedialog.askdirectory()
@@ -248,42 +303,141 @@ class MusicTagsApp:
 
 
     def run_script(self):
-        """Run the script in a separate thread."""
+        """Run the converter in a separate thread, reporting progress as it goes."""
+        if self.run_thread is not None and self.run_thread.is_alive():
+            return
         self.update_config()  # Update config with current values
+        self.config_store.save(delay=0)  # Write it right away, still off the main thread
+
+        try:
+            config = mytag_converter.validate_config(json.loads(json.dumps(self.config)))  # Give the run its own checked copy of the settings
+        except mytag_converter.ConfigError as e:
+            messagebox.showerror("Invalid Config", str(e))
+            return
+        self.cancel_event = threading.Event()
+        self.set_running(True)
 
         # Run the script in a background thread
         def thread_func():
+            output = []
             try:
-                self.root.title("Running... Please Wait") # Change window title to indicate script is running
-                result = subprocess.run(['python', 'script/mytag_converter.py'], capture_output=True, text=True)
-                output = result.stdout + "\n" + result.stderr
-                self.root.title("MyTag Extractor and Converter")
-                self.show_popup(output)
+                mytag_converter.run(config, progress_callback=self.report_progress, cancel_event=self.cancel_event, log=output.append)
             except Exception as e:
-                self.show_popup(f"Error: {str(e)}")
+                output.append(f"Error: {str(e)}")
+            self.root.after(0, self.finish_run, "\n".join(output))
+
+        self.run_thread = threading.Thread(target=thread_func, daemon=True)
+        self.run_thread.start()
+
+    def toggle_watch(self):
+        """Start processing files as they change in a separate thread, or stop if already watching."""
+        if self.run_thread is not None and self.run_thread.is_alive():
+            if self.watching:
+                self.cancel_run()
+            return
+        self.update_config()
+        self.config_store.save(delay=0)
+
+        try:
+            config = mytag_converter.validate_config(json.loads(json.dumps(self.config)))
+        except mytag_converter.ConfigError as e:
+            messagebox.showerror("Invalid Config", str(e))
+            return
+        self.cancel_event = threading.Event()
+        self.watching = True
+        self.set_running(True)
+
+        # Show the latest log line in the status line while watching
+        def thread_func():
+            output = []
 
-        thread = threading.Thread(target=thread_func)
-        thread.start()
+            def log(message):
+                output.append(str(message))
+                self.root.after(0, self.status_var.set, str(message).splitlines()[-1] if str(message) else "")
+
+            try:
+                mytag_converter.watch(config, cancel_event=self.cancel_event, log=log, progress_callback=self.report_progress)
+            except Exception as e:
+                output.append(f"Error: {str(e)}")
+            self.root.after(0, self.finish_run, "\n".join(output))
+
+        self.run_thread = threading.Thread(target=thread_func, daemon=True)
+        self.run_thread.start()
+
+    def cancel_run(self):
+        """Ask the running script to stop after the current file."""
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.status_var.set("Stopping..." if self.watching else "Cancelling...")
+
+    def set_running(self, running):
+        """Switch the buttons and window title between the running and idle states."""
+        self.run_button.config(state=tk.DISABLED if running else tk.NORMAL)
+        self.watch_button.config(state=tk.NORMAL if self.watching or not running else tk.DISABLED,
+                                 text="Stop Watching" if running and self.watching else "Watch")
+        self.cancel_button.config(state=tk.NORMAL if running else tk.DISABLED)
+        if running and self.watching:
+            self.root.title("Watching for changes...")
+        else:
+            self.root.title("Running... Please Wait" if running else "MyTag Extractor and Converter") # Change window title to indicate script is running
+        if running:
+            self.progress_bar.config(mode='determinate', value=0)
+            self.status_var.set("Starting...")
+
+    def report_progress(self, done, total, file_path, files_per_second):
+        """Receive progress from the worker thread and hand the latest value to the main thread."""
+        self.latest_progress = (done, total, file_path, files_per_second)
+        if not self.progress_scheduled:
+            # Only redraw a few times a second instead of once per file
+            self.progress_scheduled = True
+            self.root.after(100, self._show_progress)
+
+    def _show_progress(self):
+        """Update the progress bar and status line in the main thread."""
+        self.progress_scheduled = False
+        if self.latest_progress is None:
+            return
+        done, total, file_path, files_per_second = self.latest_progress
+        if total:
+            self.progress_bar.config(mode='determinate', maximum=total, value=min(done, total))
+            count = f"{done}/{total} files"
+        else:
+            self.progress_bar.config(mode='indeterminate')
+            self.progress_bar.step()
+            count = f"{done} files"
+        self.status_var.set(f"{count} - {files_per_second:.1f} files/s - {os.path.basename(file_path)}")
+
+    def finish_run(self, output):
+        """Reset the window once the run is over and show its output."""
+        cancelled = self.cancel_event is not None and self.cancel_event.is_set()
+        watched = self.watching
+        self.latest_progress = None
+        self.watching = False
+        if self.closing:
+            return  # The window is about to close
+        self.set_running(False)
+        if watched:
+            self.status_var.set("Stopped watching")
+        else:
+            self.status_var.set("Cancelled" if cancelled else "Finished")
+        self._show_popup(output)
 
     def update_config(self):
         """Update the configuration with the current GUI values."""
-        self.config["rekordbox_db_path"] = self.rekordbox_path.get()
+        self.config["rekordbox_db_path"] = self.get_rekordbox_paths()
         self.config["music_directory"] = self.music_dir_path.get()
         self.config["mytag_db_file"] = self.output_xml_path.get()
         self.config["use_rekordbox_xml"] = self.use_rekordbox_var.get()
+        self.config["force_rescan"] = self.force_rescan_var.get()
+        self.config["profile"] = self.profile_var.get()
         self.config["tag_delimiter"] = self.tag_delimiter.get()
 
-    def show_popup(self, message):
-        """Show a popup window with the output or error."""
-        # Update GUI safely by scheduling it to the main thread
-        self.root.after(0, self._show_popup, message)
-
     def _show_popup(self, message):
         """Create the popup window in the main thread."""
         popup = tk.Toplevel(self.root)
         popup.title("Script Output")
-        popup.geometry("400x300")
-        output_text = tk.Text(popup, wrap=tk.WORD)
+        popup.geometry("520x360")
+        output_text = tk.Text(popup, wrap=tk.WORD, font=("Courier", 9))  # Fixed width so the profile table lines up
         output_text.insert(tk.END, message)
         output_text.config(state=tk.DISABLED)
         output_text.pack(padx=10, pady=10)
@@ -0,0 +1,96 @@
+# Compares the old one-save-per-category MP3 writer with the coalesced writer in mytag_converter.
+# Usage: python benchmarks/bench_mp3_writes.py [--files 500]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from mutagen.mp3 import MP3
+from mutagen.id3 import ID3, COMM, TPUB, TXXX
+from mutagen.easyid3 import EasyID3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script'))
+import mytag_converter  # noqa: E402
+from synthetic import generate_mp3_library  # noqa: E402
+
+# Categories covering every write path: EasyID3 keys, COMM, TPUB, a native frame and a TXXX fallback
+CATEGORIES = {
+    "Genre": {"tags": ["House", "Trap", "Dubstep", "Disco", "Drum and Bass"], "metadata_field": "GENRE"},
+    "Components": {"tags": ["Synth", "Piano", "Kick", "Hi Hat"], "metadata_field": "COMPOSER"},
+    "Situation": {"tags": ["Warm Up", "Building", "Peak Time", "After Hours"], "metadata_field": "LABEL"},
+    "Mood": {"tags": ["Happy", "Melancholy", "Emotional", "Hype"], "metadata_field": "COMMENT"},
+    "Energy": {"tags": ["Low", "Medium", "High"], "metadata_field": "TIT3"},
+    "Venue": {"tags": ["Club", "Festival", "Bar"], "metadata_field": "VENUE"},
+}
+
+# The previous writer: every category opens, parses and saves the file again
+def legacy_update_metadata_mp3(mp3_path, categorized_tags, categories, delimiter):
+    for category, category_info in categories.items():
+        metadata_field = category_info.get('metadata_field')
+        tags = categorized_tags.get(category, [])
+        if not (metadata_field and tags):
+            continue
+        tag_str = delimiter.join(tags)
+        if metadata_field.lower() in EasyID3.valid_keys.keys():
+            audio = MP3(mp3_path, ID3=EasyID3)
+            audio[metadata_field.lower()] = tag_str
+        else:
+            audio = MP3(mp3_path, ID3=ID3)
+            if metadata_field.lower() == 'comment':
+                audio.tags.delall('COMM')
+                audio.tags.add(COMM(encoding=3, text=tag_str))
+            elif metadata_field.lower() in ('label', 'publisher'):
+                audio.tags.delall('TPUB')
+                audio.tags.add(TPUB(encoding=3, text=tag_str))
+            else:
+                audio.tags.add(TXXX(encoding=3, desc=metadata_field, text=tag_str))
+        audio.save()
+
+# Function to run a writer over every file, counting tag saves and wall time
+def run_writer(writer, paths):
+    categorized = [mytag_converter.process_comments(mytag_converter.read_comments(path), CATEGORIES) for path in paths]
+
+    saves = 0
+    original_save = ID3.save
+
+    def counting_save(self, *args, **kwargs):
+        nonlocal saves
+        saves += 1
+        return original_save(self, *args, **kwargs)
+
+    ID3.save = counting_save
+    try:
+        start = time.perf_counter()
+        for path, categorized_tags in zip(paths, categorized):
+            writer(path, categorized_tags, CATEGORIES, " / ")
+        elapsed = time.perf_counter() - start
+    finally:
+        ID3.save = original_save
+    return {'files': len(paths), 'saves': saves, 'seconds': elapsed, 'files_per_second': len(paths) / elapsed if elapsed else 0}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MP3 tag writes before and after coalescing saves.")
+    parser.add_argument('--files', type=int, default=500, help="Number of synthetic MP3 files (default: 500)")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, writer in (('before', legacy_update_metadata_mp3), ('after', mytag_converter.update_metadata_mp3)):
+        # Every writer gets its own fresh library so neither run benefits from the other's tags
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_mp3_library(directory, args.files, CATEGORIES)
+            results[name] = run_writer(writer, paths)
+
+    for name, result in results.items():
+        print(f"{name:<7} {result['files']:>6} files  {result['saves']:>6} saves  {result['seconds']:8.2f}s  {result['files_per_second']:8.1f} files/s")
+    if results['after']['seconds']:
+        print(f"speedup {results['before']['seconds'] / results['after']['seconds']:.2f}x")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# Times each phase of the converter on synthetic libraries and writes the results to JSON.
+# Usage: python benchmarks/run_benchmarks.py [--sizes 1000,10000,50000] [--output results.json] [--compare previous.json]
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'script'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import mytag_converter  # noqa: E402
+import synthetic  # noqa: E402
+
+# Same categories as example_config.json
+CATEGORIES = {
+    "Genre": {"tags": ["House", "Trap", "Dubstep", "Disco", "Drum and Bass"], "rekordbox_field": "Genre", "metadata_field": "GENRE"},
+    "Components": {"tags": ["Synth", "Piano", "Kick", "Hi Hat"], "rekordbox_field": "Composer", "metadata_field": "COMPOSER"},
+    "Situation": {"tags": ["Warm Up", "Building", "Peak Time", "After Hours", "Lounge", "House Party"], "rekordbox_field": "Label", "metadata_field": "LABEL"},
+    "Mood": {"tags": ["Happy", "Melancholy", "Emotional", "Hype", "Angry"], "rekordbox_field": "Comments", "metadata_field": "MOOD"},
+}
+DELIMITER = " / "
+
+# Function to return the peak resident set size of the current process in kB (None where the resource module is missing)
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes, Linux kB
+
+# Each phase takes the prepared library and returns the number of items it handled
+
+def phase_extract_paths(library):
+    return sum(1 for _ in mytag_converter.iter_file_paths_from_xml(library['collection']))
+
+def phase_process_comments(library):
+    rng = random.Random(1)
+    comments = [synthetic.random_comment(CATEGORIES, rng) for _ in range(library['size'])]
+    for comment in comments:
+        mytag_converter.process_comments([comment], CATEGORIES)
+    return len(comments)
+
+def phase_categorizer_batch(library):
+    rng = random.Random(1)
+    comments = [[synthetic.random_comment(CATEGORIES, rng)] for _ in range(library['size'])]
+    mytag_converter.process_comments_batch(comments, mytag_converter.Categorizer(CATEGORIES))
+    return len(comments)
+
+def phase_update_track_in_xml(library):
+    # One call parses and rewrites the whole collection, so time a single track
+    mytag_converter.update_track_in_xml(library['collection_copy'], library['paths'][0], {"Genre": ["House"]}, CATEGORIES, DELIMITER)
+    return 1
+
+def phase_collection_commit(library):
+    collection = mytag_converter.RekordboxCollection(library['collection_copy'])
+    for path in library['paths']:
+        collection.stage(path, {"Genre": "House", "Label": "Peak Time"})
+    return collection.commit()
+
+def run_update_xml(library, force_rescan):
+    paths = mytag_converter.extract_file_paths_from_xml(library['collection'])
+    mytag_converter.update_xml(library['mytag_db'], library['collection_copy'], paths, CATEGORIES, DELIMITER, True,
+                               checkpoint_interval=0, workers=library['workers'], force_rescan=force_rescan, log=lambda message: None)
+    return len(paths)
+
+def phase_update_xml_full(library):
+    return run_update_xml(library, force_rescan=True)
+
+def phase_update_xml_incremental(library):
+    return run_update_xml(library, force_rescan=False)
+
+# Phases run in this order; the incremental run relies on the full run before it
+PHASES = {
+    'extract_file_paths_from_xml': phase_extract_paths,
+    'process_comments': phase_process_comments,
+    'categorizer_batch': phase_categorizer_batch,
+    'update_track_in_xml': phase_update_track_in_xml,
+    'collection_commit': phase_collection_commit,
+    'update_xml_full': phase_update_xml_full,
+    'update_xml_incremental': phase_update_xml_incremental,
+}
+
+# Function run in a child process so every phase gets its own peak RSS
+def run_phase(name, library, queue):
+    start = time.perf_counter()
+    items = PHASES[name](library)
+    seconds = time.perf_counter() - start
+    queue.put({'items': items, 'seconds': seconds, 'items_per_second': items / seconds if seconds else None, 'peak_rss_kb': peak_rss_kb()})
+
+# Function to generate the synthetic library and collection for one size
+def prepare_library(workdir, size, workers):
+    directory = os.path.join(workdir, f"library_{size}")
+    start = time.perf_counter()
+    paths = synthetic.generate_library(os.path.join(directory, "music"), size, CATEGORIES)
+    collection = os.path.join(directory, "collection.xml")
+    synthetic.write_collection_xml(collection, paths)
+    print(f"  generated {size} files in {time.perf_counter() - start:.1f}s")
+    return {'size': size, 'paths': paths, 'collection': collection, 'collection_copy': os.path.join(directory, "collection_out.xml"),
+            'mytag_db': os.path.join(directory, "MyTags.xml"), 'workers': workers}
+
+def benchmark_size(workdir, size, workers, phases):
+    library = prepare_library(workdir, size, workers)
+    shutil.copyfile(library['collection'], library['collection_copy'])
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in phases:
+        queue = context.Queue()
+        process = context.Process(target=run_phase, args=(name, library, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results[name] = result
+        rate = f"{result['items_per_second']:10.1f}/s" if result['items_per_second'] else ' ' * 12
+        print(f"  {name:<28} {result['items']:>7} items {result['seconds']:9.3f}s {rate}  peak RSS {result['peak_rss_kb']} kB")
+    return results
+
+# Function to print how each phase compares to a previous results file
+def compare(results, previous_path):
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)['results']
+    print(f"\nCompared with {previous_path} (time ratio, >1.00 is slower):")
+    for size, phases in results.items():
+        for name, result in phases.items():
+            before = previous.get(size, {}).get(name)
+            if before and before['seconds']:
+                print(f"  {size:>7} {name:<28} {result['seconds'] / before['seconds']:6.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MyTag converter on synthetic libraries.")
+    parser.add_argument('--sizes', default='1000,10000,50000', help="Comma separated library sizes (default: 1000,10000,50000)")
+    parser.add_argument('--phases', default=','.join(PHASES), help="Comma separated phases to run (default: all)")
+    parser.add_argument('--workers', type=int, default=1, help="Worker threads for the update_xml phases (default: 1)")
+    parser.add_argument('--workdir', help="Directory for the generated libraries (default: a temporary directory that is removed afterwards)")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file to write the results to")
+    parser.add_argument('--compare', help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    phases = [name for name in args.phases.split(',') if name]
+    unknown = [name for name in phases if name not in PHASES]
+    if unknown:
+        parser.error(f"unknown phases: {', '.join(unknown)}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='mytag_benchmark_')
+    results = {}
+    try:
+        for size in sizes:
+            print(f"{size} tracks:")
+            results[str(size)] = benchmark_size(workdir, size, args.workers, phases)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'workers': args.workers,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import random
+import struct
+from urllib.parse import quote
+
+from mutagen.id3 import ID3, COMM
+
+# One silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, 417 bytes), enough for Mutagen to recognise an MP3
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + b'\0' * 413
+
+# FLAC STREAMINFO for 44.1 kHz / 2 channels / 16 bit with no audio frames
+FLAC_STREAMINFO = (struct.pack('>HH', 4096, 4096) + b'\0' * 6
+                   + ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, 'big') + b'\0' * 16)
+
+# Function to build a Rekordbox style MyTag comment from a random selection of the configured tags
+def random_comment(categories, rng, max_tags=6):
+    vocabulary = [tag for category_info in categories.values() for tag in category_info['tags']]
+    tags = rng.sample(vocabulary, min(len(vocabulary), rng.randint(1, max_tags)))
+    return f"/* {' / '.join(tags)} */"
+
+# Function to build a FLAC metadata block header
+def flac_block(block_type, data, last=False):
+    return bytes([block_type | (0x80 if last else 0)]) + len(data).to_bytes(3, 'big') + data
+
+# Function to write a minimal FLAC file with a MyTag comment and optionally a cover picture of picture_bytes
+def write_flac(path, comment, picture_bytes=0):
+    vendor = b'mytag-benchmark'
+    entries = [f"COMMENT={comment}".encode('utf-8'), b"TITLE=Synthetic"]
+    vorbis = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(entries))
+    vorbis += b''.join(struct.pack('<I', len(entry)) + entry for entry in entries)
+
+    blocks = [flac_block(0, FLAC_STREAMINFO), flac_block(4, vorbis)]
+    if picture_bytes:
+        mime, description = b'image/jpeg', b''
+        picture = (struct.pack('>II', 3, len(mime)) + mime + struct.pack('>I', len(description)) + description
+                   + struct.pack('>IIIII', 500, 500, 24, 0, picture_bytes) + os.urandom(picture_bytes))
+        blocks.append(flac_block(6, picture))
+    blocks.append(flac_block(1, b'\0' * 1024, last=True))  # Padding, as written by most taggers
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + b''.join(blocks))
+
+# Function to write a minimal MP3 file with a MyTag comment in its COMM frame
+def write_mp3(path, comment, frames=20):
+    with open(path, 'wb') as f:
+        f.write(MP3_FRAME * frames)
+    tags = ID3()
+    tags.add(COMM(encoding=3, lang='eng', desc='', text=comment))
+    tags.save(path)
+
+# Function to generate a directory of synthetic MP3 files and return their paths
+def generate_mp3_library(directory, count, categories, seed=0):
+    return generate_library(directory, count, categories, seed, flac_ratio=0.0)
+
+# Function to generate a library of synthetic FLAC and MP3 files spread over sub directories, returning their paths
+def generate_library(directory, count, categories, seed=0, flac_ratio=0.5, files_per_directory=200, picture_bytes=0):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        sub_directory = os.path.join(directory, f"Artist {i // files_per_directory:04d}")
+        os.makedirs(sub_directory, exist_ok=True)
+        comment = random_comment(categories, rng)
+        if rng.random() < flac_ratio:
+            path = os.path.join(sub_directory, f"track {i:06d}.flac")
+            write_flac(path, comment, picture_bytes)
+        else:
+            path = os.path.join(sub_directory, f"track {i:06d}.mp3")
+            write_mp3(path, comment)
+        paths.append(path)
+    return paths
+
+# Function to turn a file path into a Rekordbox Location URL
+def path_to_location(path):
+    path = path.replace(os.sep, '/')
+    if not path.startswith('/'):
+        path = '/' + path  # Windows drive letter paths
+    return "file://localhost" + quote(path)
+
+# Function to write a Rekordbox collection XML that references the given files, with a playlist section like a real export
+def write_collection_xml(path, file_paths, playlist_size=500):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<DJ_PLAYLISTS Version="1.0.0">\n')
+        f.write('  <PRODUCT Name="rekordbox" Version="6.8.0" Company="AlphaTheta"/>\n')
+        f.write(f'  <COLLECTION Entries="{len(file_paths)}">\n')
+        for track_id, file_path in enumerate(file_paths, 1):
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            kind = "FLAC File" if file_path.lower().endswith('.flac') else "MP3 File"
+            f.write(f'    <TRACK TrackID="{track_id}" Name="{name}" Artist="Synthetic" Composer="" Album="" Grouping="" Genre="" '
+                    f'Kind="{kind}" Size="0" TotalTime="1" DiscNumber="0" TrackNumber="0" Year="0" AverageBpm="124.00" '
+                    f'DateAdded="2024-01-01" BitRate="128" SampleRate="44100" Comments="" PlayCount="0" Rating="0" '
+                    f'Location="{path_to_location(file_path)}" Remixer="" Tonality="" Label="" Mix="">\n')
+            f.write('      <TEMPO Inizio="0.000" Bpm="124.00" Metro="4/4" Battito="1"/>\n')
+            f.write('    </TRACK>\n')
+        f.write('  </COLLECTION>\n  <PLAYLISTS>\n    <NODE Type="0" Name="ROOT" Count="1">\n')
+        entries = min(playlist_size, len(file_paths))
+        f.write(f'      <NODE Name="Synthetic" Type="1" KeyType="0" Entries="{entries}">\n')
+        for track_id in range(1, entries + 1):
+            f.write(f'        <TRACK Key="{track_id}"/>\n')
+        f.write('      </NODE>\n    </NODE>\n  </PLAYLISTS>\n</DJ_PLAYLISTS>\n')
@@ -1,17 +1,219 @@
 import os
+import sys
 import re
+import io
+import csv
 import json
+import hashlib
+import struct
+import errno
+import functools
+import time
+import shutil
+import fnmatch
+import tempfile
+import sqlite3
+import signal
+import argparse
+import cProfile
+import queue
+import threading
 import xml.etree.ElementTree as ET
-import importlib
-from mutagen.flac import FLAC
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, COMM, TPUB, TXXX
-from mutagen.easyid3 import EasyID3
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from types import MappingProxyType
+from urllib.parse import unquote, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+# Mutagen is only imported by load_mutagen() once a file actually has to be opened, so the command line starts quickly
+FLAC = ID3 = ID3NoHeaderError = Frames = TextFrame = COMM = TPUB = TXXX = EasyID3 = None
+
+# Function to import Mutagen on first use; every function that uses the names above calls it first
+def load_mutagen():
+    global FLAC, ID3, ID3NoHeaderError, Frames, TextFrame, COMM, TPUB, TXXX, EasyID3
+    if EasyID3 is None:
+        from mutagen.flac import FLAC
+        from mutagen.id3 import ID3, ID3NoHeaderError, Frames, TextFrame, COMM, TPUB, TXXX
+        from mutagen.easyid3 import EasyID3
+
+# Every config key the converter and the GUI understand, with the value used when it is missing. The type of each
+# default is also the type the key must have.
+CONFIG_DEFAULTS = {
+    "use_rekordbox_xml": False,
+    "rekordbox_db_path": "",
+    "music_directory": "",
+    "scan_include": ["*.flac", "*.mp3"],
+    "scan_exclude": [],
+    "scan_symlinks": "files",
+    "scan_workers": 1,
+    "scan_cache": True,
+    "mytag_db_file": "MyTags.xml",
+    "mytag_db_format": "xml",
+    "mytag_checkpoint_interval": 1000,
+    "workers": 1,
+    "pipeline_queue_size": 256,
+    "collection_spill_threshold": 10000,
+    "force_rescan": False,
+    "resume": False,
+    "dry_run": False,
+    "plan_file": "mytag_plan.json",
+    "profile": False,
+    "profile_dump": "",
+    "tag_delimiter": " / ",
+    "tag_case_insensitive": False,
+    "tag_normalize_whitespace": False,
+    "categories": {},
+}
+
+# Keys that take either one string or a list of strings
+CONFIG_STRING_LISTS = ("rekordbox_db_path",)
+
+# Keys that only accept a few values
+CONFIG_CHOICES = {
+    "scan_symlinks": ('files', 'follow', 'skip'),
+    "mytag_db_format": ('xml', 'sqlite'),
+}
+
+# The categories written to a new config
+DEFAULT_CATEGORIES = {
+    "Genre": {
+        "tags": ["House", "Trap", "Dubstep", "Disco", "Drum and Bass"],
+        "rekordbox_field": "Genre",
+        "metadata_field": "GENRE"
+    },
+    "Components": {
+        "tags": ["Synth", "Piano", "Kick", "Hi Hat"],
+        "rekordbox_field": "Composer",
+        "metadata_field": "COMPOSER"
+    },
+    "Situation": {
+        "tags": ["Warm Up", "Building", "Peak Time", "After Hours", "Lounge", "House Party"],
+        "rekordbox_field": "Label",
+        "metadata_field": "LABEL"
+    },
+    "Mood": {
+        "tags": ["Happy", "Melancholy", "Emotional", "Hype", "Angry"],
+        "rekordbox_field": "Comments",
+        "metadata_field": "COMMENT"
+    }
+}
+
+class ConfigError(ValueError):
+    """Raised when a config file or dict does not match the config schema."""
+
+# Function to check a config against the schema and return a copy with the defaults filled in. Numbers saved as
+# strings are converted, but true/false or a fraction for a whole-number key is an error rather than being truncated;
+# anything else of the wrong type raises ConfigError. Unknown keys are kept as they are.
+def validate_config(config):
+    if not isinstance(config, dict):
+        raise ConfigError("The config must be a JSON object")
+    validated = json.loads(json.dumps(CONFIG_DEFAULTS))
+    errors = []
+    for key, value in config.items():
+        if key not in CONFIG_DEFAULTS:
+            validated[key] = value
+            continue
+        if value is None:
+            continue  # null means use the default
+        default = CONFIG_DEFAULTS[key]
+        if key in CONFIG_STRING_LISTS and isinstance(value, list):
+            if not all(isinstance(item, str) for item in value):
+                errors.append(f"{key} must be a string or a list of strings")
+                continue
+        elif isinstance(default, bool):
+            if not isinstance(value, bool):
+                errors.append(f"{key} must be true or false")
+                continue
+        elif isinstance(default, int):
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                errors.append(f"{key} must be a whole number")
+                continue
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                errors.append(f"{key} must be a whole number")
+                continue
+            if value < 0:
+                errors.append(f"{key} must not be negative")
+                continue
+        elif not isinstance(value, type(default)):
+            errors.append(f"{key} must be a {type(default).__name__}")
+            continue
+        if key in CONFIG_CHOICES and value not in CONFIG_CHOICES[key]:
+            errors.append(f"{key} must be one of {', '.join(CONFIG_CHOICES[key])}")
+            continue
+        validated[key] = value
+
+    for category, category_info in validated["categories"].items():
+        if not isinstance(category_info, dict):
+            errors.append(f"Category {category} must be an object")
+        elif not isinstance(category_info.get("tags", []), list) or not all(isinstance(tag, str) for tag in category_info.get("tags", [])):
+            errors.append(f"The tags of category {category} must be a list of strings")
+        elif not all(isinstance(category_info.get(field, ""), str) for field in ("rekordbox_field", "metadata_field")):
+            errors.append(f"The fields of category {category} must be strings")
+
+    if errors:
+        raise ConfigError("; ".join(errors))
+    return validated
 
 # Function to load the configuration (categories and XML database path)
 def load_config(config_file):
     with open(config_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        try:
+            config = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"{config_file} is not valid JSON: {e}") from e
+    return validate_config(config)
+
+class ConfigStore:
+    """Config held in memory and written to disk after a short idle period, atomically and off the calling thread.
+
+    Call save() after changing data; repeated calls within delay seconds only write once. close() writes any
+    pending change before returning.
+    """
+
+    def __init__(self, path, data, delay=1.0):
+        self.path = path
+        self.data = data
+        self.delay = delay
+        self.lock = threading.Lock()  # Guards pending and timer
+        self.write_lock = threading.Lock()  # Only one write at a time, always of the newest snapshot
+        self.timer = None
+        self.pending = None  # Serialized config waiting to be written
+
+    @classmethod
+    def open(cls, path, delay=1.0):
+        """Load and validate the config at path, or start from the defaults if it does not exist."""
+        data = load_config(path) if os.path.exists(path) else json.loads(json.dumps(CONFIG_DEFAULTS))
+        return cls(path, data, delay)
+
+    def save(self, delay=None):
+        """Snapshot the config now and write it once no other save has happened for delay seconds."""
+        # Serializing here, on the caller's thread, means the writer never sees the dict while it is being changed
+        snapshot = json.dumps(self.data, indent=4)
+        with self.lock:
+            self.pending = snapshot
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay if delay is None else delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write the pending snapshot, if any."""
+        with self.write_lock:
+            with self.lock:
+                snapshot, self.pending = self.pending, None
+            if snapshot is not None:
+                write_file_atomic(self.path, lambda f: f.write(snapshot.encode('utf-8')))
+
+    def close(self):
+        """Stop the timer and write any pending change before returning."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.flush()
         
 def RegisterCommentKey(lang='\0\0\0', desc=''):
         frameid = ':'.join(('COMM', desc, lang))
@@ -29,237 +231,2541 @@ def RegisterCommentKey(lang='\0\0\0', desc=''):
 
         EasyID3.RegisterKey('comment', getter, setter, deleter)
 
+# Function to stream the file paths out of the XML database without loading the whole tree
+def iter_file_paths_from_xml(rekordbox_db_path):
+    # Every element is cleared and detached from its parent once it has been read, so memory use stays
+    # flat no matter how many tracks and playlists the export contains
+    parents = []
+    for event, element in ET.iterparse(rekordbox_db_path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == "TRACK":
+            location = element.get("Location")
+            if location:
+                yield location_to_path(location)
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+
+# Function to get the list of Rekordbox collection paths from the 'rekordbox_db_path' config value, which can be a
+# single path or a list of them
+def collection_paths(rekordbox_db_path):
+    if isinstance(rekordbox_db_path, (list, tuple)):
+        return [path for path in rekordbox_db_path if path]
+    return [rekordbox_db_path] if rekordbox_db_path else []
+
+# Function to stream the file paths of several XML databases, each file only once. Only needs to remember the paths
+# already seen when there is more than one collection.
+def iter_file_paths_from_xmls(rekordbox_db_paths):
+    if len(rekordbox_db_paths) == 1:
+        yield from iter_file_paths_from_xml(rekordbox_db_paths[0])
+        return
+    seen = set()
+    for rekordbox_db_path in rekordbox_db_paths:
+        for file_path in iter_file_paths_from_xml(rekordbox_db_path):
+            if file_path not in seen:
+                seen.add(file_path)
+                yield file_path
+
+# Function to read the track count Rekordbox stores on the COLLECTION element, without reading the tracks themselves
+def count_tracks_in_xml(rekordbox_db_path):
+    for _, element in ET.iterparse(rekordbox_db_path, events=('start',)):
+        if element.tag == "COLLECTION":
+            entries = element.get("Entries")
+            return int(entries) if entries and entries.isdigit() else None
+        if element.tag == "TRACK":
+            break
+    return None
+
 # Function to extract file paths from the XML database
 def extract_file_paths_from_xml(rekordbox_db_path):
-    tree = ET.parse(rekordbox_db_path)
-    root = tree.getroot()
-
-    file_paths = []
-    # Iterate over each TRACK element to extract the Location attribute
-    for track in root.iter("TRACK"):
-        location = track.get("Location")
-        if location:
-            # Decode the URL-encoded path and append it to the list
-            file_paths.append(location.replace("file://localhost/", "").replace("%20", " "))
-    
-    return file_paths
+    return list(iter_file_paths_from_xml(rekordbox_db_path))
 
+class DirectoryScanner:
+    """Streams matching file paths out of a directory tree with os.scandir, optionally listing directories in parallel.
+
+    symlinks is 'files' (follow links to files but do not descend into linked directories, like os.walk), 'follow'
+    (also descend into linked directories, each directory at most once) or 'skip' (ignore links entirely).
+    With a cache_path, the listing of every directory is remembered together with the directory's mtime, and a
+    directory whose mtime has not changed is not listed again on the next scan.
+    """
+
+    def __init__(self, root, include=('*.flac', '*.mp3'), exclude=(), symlinks='files', workers=1, cache_path=None):
+        self.root = root
+        self.include = [pattern.lower() for pattern in include]
+        self.exclude = [pattern.lower() for pattern in exclude]
+        self.symlinks = symlinks
+        self.workers = workers
+        self.cache_path = cache_path
+        self.cache = {}
+        self.cache_hits = 0
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    self.cache = json.load(f)
+            except (OSError, ValueError):
+                self.cache = {}
+        self.new_cache = {}
+
+    def excluded(self, relative_path, name):
+        """Return True if a file or directory matches one of the exclude globs."""
+        relative_path, name = relative_path.lower(), name.lower()
+        return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in self.exclude)
+
+    def matches(self, file_path):
+        """Return True if a file below the root would be returned by a scan, judging by the include and exclude globs."""
+        relative = os.path.relpath(file_path, self.root)
+        if relative == os.curdir or relative.split(os.sep)[0] == os.pardir:
+            return False
+        parts = relative.split(os.sep)
+        if not any(fnmatch.fnmatch(parts[-1].lower(), pattern) for pattern in self.include):
+            return False
+        return not any(self.excluded('/'.join(parts[:index + 1]), part) for index, part in enumerate(parts))
+
+    def list_directory(self, directory):
+        """Return ([(name, is_symlink)] for files, [(name, is_symlink, (device, inode))] for directories) of one directory."""
+        stat = os.stat(directory)
+        cached = self.cache.get(directory)
+        if cached is not None and cached['mtime_ns'] == stat.st_mtime_ns:
+            self.cache_hits += 1
+            listing = cached
+        else:
+            files, dirs = [], []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            dirs.append([entry.name, entry.is_symlink()])
+                        elif entry.is_file():
+                            files.append([entry.name, entry.is_symlink()])
+                    except OSError:
+                        continue  # Broken link or entry that vanished while listing
+            listing = {'mtime_ns': stat.st_mtime_ns, 'files': sorted(files), 'dirs': sorted(dirs)}
+
+        # A directory changed in the last couple of seconds could change again within the same mtime tick, so it is not cached
+        if time.time_ns() - stat.st_mtime_ns > 2_000_000_000:
+            self.new_cache[directory] = listing
+        return listing, (stat.st_dev, stat.st_ino)
+
+    def scan_directory(self, directory):
+        """List one directory and return (matching file paths, sub directories to descend into, directory identity)."""
+        listing, identity = self.list_directory(directory)
+        relative = os.path.relpath(directory, self.root)
+        relative = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+
+        files = []
+        for name, is_symlink in listing['files']:
+            if is_symlink and self.symlinks == 'skip':
+                continue
+            lower = name.lower()
+            if any(fnmatch.fnmatch(lower, pattern) for pattern in self.include) and not self.excluded(relative + name, name):
+                files.append(os.path.join(directory, name))
+
+        sub_directories = []
+        for name, is_symlink in listing['dirs']:
+            if is_symlink and self.symlinks != 'follow':
+                continue
+            if not self.excluded(relative + name, name):
+                sub_directories.append(os.path.join(directory, name))
+        return files, sub_directories, identity
+
+    def __iter__(self):
+        seen = set()  # (device, inode) of listed directories, so followed links cannot loop
+
+        if self.workers <= 1:
+            stack = [self.root]
+            while stack:
+                directory = stack.pop()
+                try:
+                    files, sub_directories, identity = self.scan_directory(directory)
+                except OSError:
+                    continue
+                if identity in seen:
+                    continue
+                seen.add(identity)
+                yield from files
+                stack.extend(reversed(sub_directories))  # Depth first, in name order
+        else:
+            # Sub directories are listed concurrently, ahead of time, but the listings are taken in the same depth first
+            # name order as above, so the files come out in the same order whatever the number of workers
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                stack = [executor.submit(self.scan_directory, self.root)]
+                while stack:
+                    future = stack.pop()
+                    try:
+                        files, sub_directories, identity = future.result()
+                    except OSError:
+                        continue
+                    if identity in seen:
+                        continue
+                    seen.add(identity)
+                    yield from files
+                    stack.extend(reversed([executor.submit(self.scan_directory, sub_directory) for sub_directory in sub_directories]))
+
+        # Only a complete scan replaces the cache, so an interrupted run does not forget directories it never reached
+        if self.cache_path:
+            write_json_atomic(self.new_cache, self.cache_path)
+
+    @staticmethod
+    def cache_path_for(mytag_db_file):
+        """Return the directory cache path that belongs to a MyTags database file."""
+        return os.path.splitext(mytag_db_file)[0] + '.dircache.json'
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a scanner for the music directory from the scan settings in a config dict."""
+        mytag_db_file = config.get('mytag_db_file')
+        use_cache = config.get('scan_cache', True) and mytag_db_file
+        return cls(config.get('music_directory'),
+                   include=config.get('scan_include') or ('*.flac', '*.mp3'),
+                   exclude=config.get('scan_exclude') or (),
+                   symlinks=config.get('scan_symlinks', 'files'),
+                   workers=int(config.get('scan_workers', 1)),
+                   cache_path=cls.cache_path_for(mytag_db_file) if use_cache else None)
+
+# Function to list the FLAC and MP3 files in a directory tree
 def get_file_paths_from_directory(music_directory):
-    file_paths = []
-    for root_dir, _, files in os.walk(music_directory):
-        for file in files:
-            if file.lower().endswith(('.flac', '.mp3')):
-                file_paths.append(os.path.join(root_dir, file))
-    return file_paths
+    return list(DirectoryScanner(music_directory))
+
+# Rekordbox writes the MyTags of a track into its comment as "/* tag / tag / tag */"
+MYTAG_PATTERN = re.compile(r'/\*(.*?)\*/', re.DOTALL)
+
+class Categorizer:
+    """Tag -> category lookup table compiled once from the categories config."""
+
+    def __init__(self, categories, case_insensitive=False, normalize_whitespace=False):
+        self.categories = categories
+        self.case_insensitive = case_insensitive
+        self.normalize_whitespace = normalize_whitespace
+
+        # Map each (normalized) tag to its category and its spelling in the config. A tag listed under
+        # several categories belongs to the first one, the same as the old linear search.
+        lookup = {}
+        for category, category_info in categories.items():
+            for tag in category_info.get('tags', []):
+                lookup.setdefault(self.normalize(tag), (category, tag))
+        self.lookup = MappingProxyType(lookup)
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a categorizer from the categories and matching options in a config dict."""
+        return cls(config.get('categories') or {},
+                   case_insensitive=bool(config.get('tag_case_insensitive', False)),
+                   normalize_whitespace=bool(config.get('tag_normalize_whitespace', False)))
+
+    @property
+    def options(self):
+        """Return the matching options, used to tell whether cached results are still valid."""
+        return {'case_insensitive': self.case_insensitive, 'normalize_whitespace': self.normalize_whitespace}
+
+    def normalize(self, tag):
+        """Return the key a tag is looked up by in the current matching mode."""
+        if self.normalize_whitespace:
+            tag = ' '.join(tag.split())
+        if self.case_insensitive:
+            tag = tag.casefold()
+        return tag
+
+    def categorize(self, comments):
+        """Sort the MyTags found in a list of comment strings into their categories."""
+        categorized_tags = {category: [] for category in self.categories}
+        categorized_tags['No Category'] = []
+        lookup = self.lookup
+        exact = not (self.case_insensitive or self.normalize_whitespace)
+
+        for comment in comments:
+            for match in MYTAG_PATTERN.findall(comment):
+                # Split tags by " / " and strip extra whitespace
+                for tag in match.split(" / "):
+                    tag = tag.strip()
+                    entry = lookup.get(tag if exact else self.normalize(tag))
+                    if entry is None:
+                        categorized_tags['No Category'].append(tag)
+                    else:
+                        # Store the tag as it is spelled in the config
+                        categorized_tags[entry[0]].append(entry[1])
+        return categorized_tags
+
+    def categorize_batch(self, comment_batches):
+        """Categorize the comments of many files at once, returning one result per file."""
+        return [self.categorize(comments) for comments in comment_batches]
 
 # Function to process the comments and organize them under categories
 def process_comments(comments, categories):
-    pattern = re.compile(r'/\*(.*?)\*/', re.DOTALL)
-    categorized_tags = {category: [] for category in categories}
-    categorized_tags['No Category'] = []
+    categorizer = categories if isinstance(categories, Categorizer) else Categorizer(categories)
+    return categorizer.categorize(comments)
 
-    for comment in comments:
-        matches = pattern.findall(comment)
-        for match in matches:
-            # Split tags by " / " and strip extra whitespace
-            tags = [tag.strip() for tag in match.split(" / ")]
-
-            # Process each tag separately
-            for tag in tags:
-                assigned = False
-                # Check if the tag matches any category
-                for category, category_info in categories.items():
-                    if tag in category_info['tags']:
-                        categorized_tags[category].append(tag)
-                        assigned = True
-                        break
-                if not assigned:
-                    categorized_tags['No Category'].append(tag)
-    return categorized_tags
+# Function to categorize the comments of many files with a single compiled categorizer
+def process_comments_batch(comment_batches, categories):
+    categorizer = categories if isinstance(categories, Categorizer) else Categorizer(categories)
+    return categorizer.categorize_batch(comment_batches)
+
+# Function to get the name a metadata field is stored under in a FLAC file
+def flac_field_name(metadata_field):
+    return 'LABEL' if metadata_field.upper() == 'PUBLISHER' else metadata_field
+
+# Function to read the current values of a metadata field from a loaded FLAC file (None if the field is not set)
+def read_flac_field(audio, metadata_field):
+    return audio.get(flac_field_name(metadata_field))
+
+# Function to turn a metadata value into the list of strings its field should hold: a string is a single value, a list
+# holds several (multi-valued fields) and None means the field should not exist
+def field_values(value):
+    if value is None:
+        return None
+    return [value] if isinstance(value, str) else [str(item) for item in value]
+
+# Function to check whether the current values of a field (None if it is missing) already match a metadata value. A
+# missing field counts as holding an empty value.
+def field_holds(current, value):
+    wanted = field_values(value)
+    return current == wanted or (current is None and wanted in (None, ['']))
+
+# Function to write metadata field values to a FLAC file. values maps each field to a string, a list of strings or
+# None to remove the field. Fields that already hold their value are left alone and the file is only saved if
+# something differs. Returns the size of the saved file, or 0 if nothing had to be written. audio can be the file
+# already loaded into Mutagen.
+def write_metadata_flac(flac_path, values, audio=None):
+    if not values:
+        return 0
+    if audio is None:
+        load_mutagen()
+        audio = FLAC(flac_path)
+    changed = False
+    for metadata_field, value in values.items():
+        if not field_holds(read_flac_field(audio, metadata_field), value):
+            if value is None:
+                del audio[flac_field_name(metadata_field)]
+            else:
+                audio[flac_field_name(metadata_field)] = field_values(value)
+            changed = True
+    if not changed:
+        return 0
+
+    # Save the changes to the FLAC file
+    audio.save()
+    return os.path.getsize(flac_path)
 
 # Function to update metadata fields in FLAC files
 def update_metadata_flac(flac_path, categorized_tags, categories, delimiter):
-    audio = FLAC(flac_path)
-    
-    # For each category, update the corresponding metadata field
+    return write_metadata_flac(flac_path, build_metadata_values(categorized_tags, categories, delimiter))
+
+# Function to build the metadata field values for a file from its categorized tags
+def build_metadata_values(categorized_tags, categories, delimiter):
+    values = {}
     for category, category_info in categories.items():
         metadata_field = category_info.get('metadata_field')
-        if metadata_field.upper() == 'PUBLISHER': metadata_field = 'LABEL'
-        
         if metadata_field:
-            # Get the tags for the category and join them into a single string
             tags = categorized_tags.get(category, [])
             if tags:
-                # Join the tags with " / " if needed
-                audio[metadata_field] = delimiter.join(tags)
+                values[metadata_field] = delimiter.join(tags)
+    return values
 
-    # Save the changes to the FLAC file
-    audio.save()
+# Function to work out which ID3 frame a metadata field is stored in
+def resolve_id3_field(metadata_field):
+    load_mutagen()
+    field = metadata_field.lower()
+    if field in EasyID3.valid_keys.keys():  # Check if given metadata field is compatible with EasyID3
+        return ('easy', field)
+    if field == 'comment':
+        return ('COMM', None)
+    if field in ('label', 'publisher'):
+        return ('TPUB', None)
+    frame = Frames.get(metadata_field.upper())
+    if frame is not None and issubclass(frame, TextFrame) and frame is not TXXX:  # Any 4 character ID3 text frame
+        return ('frame', frame)
+    return ('TXXX', metadata_field)
+
+# Function to set a metadata field on a loaded ID3 tag to a string or a list of strings
+def set_id3_field(tags, metadata_field, value):
+    kind, target = resolve_id3_field(metadata_field)
+    text = field_values(value)
+    if kind == 'easy':
+        EasyID3.Set[target](tags, target, text)
+    elif kind == 'COMM':
+        tags.delall('COMM')
+        tags.add(COMM(encoding=3, text=text))
+    elif kind == 'TPUB':
+        tags.delall('TPUB')
+        tags.add(TPUB(encoding=3, text=text))
+    elif kind == 'frame':
+        tags.add(target(encoding=3, text=text))
+    else:
+        tags.add(TXXX(encoding=3, desc=target, text=text))
+
+# Function to remove a metadata field from a loaded ID3 tag
+def delete_id3_field(tags, metadata_field):
+    kind, target = resolve_id3_field(metadata_field)
+    if kind == 'easy':
+        EasyID3.Delete[target](tags, target)
+    elif kind == 'frame':
+        tags.delall(target.__name__)
+    elif kind == 'TXXX':
+        tags.delall(f'TXXX:{target}')
+    else:
+        tags.delall(kind)
+
+# Function to read the current values of a metadata field from a loaded ID3 tag (None if the field is not set)
+def read_id3_field(tags, metadata_field):
+    kind, target = resolve_id3_field(metadata_field)
+    if kind == 'easy':
+        try:
+            return EasyID3.Get[target](tags, target)
+        except KeyError:
+            return None
+    elif kind == 'frame':
+        frames = tags.getall(target.__name__)
+    elif kind == 'TXXX':
+        frames = tags.getall(f'TXXX:{target}')
+    else:
+        frames = tags.getall(kind)
+    if not frames:
+        return None
+    return [str(text) for frame in frames for text in frame.text]
+
+# Function to load the ID3 tag of an MP3 file, or an empty one if the file has none yet
+def load_id3(mp3_path):
+    load_mutagen()
+    try:
+        return ID3(mp3_path)
+    except ID3NoHeaderError:
+        return ID3()
+
+# Function to write metadata field values (see write_metadata_flac) to an MP3 file with a single load and save. Frames
+# that already hold the value are left alone and the file is only saved if something differs. Returns the size of the
+# saved file, or 0.
+def write_metadata_mp3(mp3_path, values, tags=None):
+    if not values:
+        return 0
+    if tags is None:
+        tags = load_id3(mp3_path)
+    changed = False
+    for metadata_field, value in values.items():
+        if not field_holds(read_id3_field(tags, metadata_field), value):
+            if value is None:
+                delete_id3_field(tags, metadata_field)
+            else:
+                set_id3_field(tags, metadata_field, value)
+            changed = True
+    if not changed:
+        return 0
+    tags.save(mp3_path)
+    return os.path.getsize(mp3_path)
 
 # Function to update metadata fields in MP3 files using Mutagen
 def update_metadata_mp3(mp3_path, categorized_tags, categories, delimiter):
-    
-    # For each category, update the corresponding metadata field
-    for category, category_info in categories.items():
-        metadata_field = category_info.get('metadata_field')
-        
-        if metadata_field:
-            # Get the tags for the category and join them into a single string
-            tags = categorized_tags.get(category, [])        
-            if tags and metadata_field.lower() in EasyID3.valid_keys.keys(): #Check if given metadatafield is compatible with EasyID3
-                # Join the tags with " / " if needed
-                audio = MP3(mp3_path, ID3=EasyID3)
-                tag_str = delimiter.join(tags)
-                audio[metadatafield] = tag_str
-                # Save the changes to the MP3 file
-                audio.save()
-            elif tags and metadata_field not in EasyID3.valid_keys.keys():
-                audio = MP3(mp3_path, ID3=ID3)
-                tag_str = delimiter.join(tags)
-                mod = 'mutagen.id3.' + metadata_field.upper()
-                # Use mutagen's ID3 to set the tag
-                if  metadata_field.lower() == 'comment':
-                    audio.tags.delall('COMM')
-                    audio.tags.add(COMM(encoding=3, text=tag_str))
-                elif metadata_field.lower() == 'label' or 'publisher':
-                    audio.tags.delall('TPUB')
-                    audio.tags.add(TPUB(encoding=3, text=tag_str))
-                elif (spec := importlib.util.find_spec(mod)) is not None:
-                    module = importlib.import_module(metadata_field, package=mutagen.id3)
-                    audio.tags.add(module(encoding=3, text=tag_str))                    
-                else:
-                    audio.tags.add(TXXX(encoding=3, desc=metadata_field, text=tag_str))
-                audio.save()
+    # Load the ID3 tag once, apply every category's frame and save once
+    return write_metadata_mp3(mp3_path, build_metadata_values(categorized_tags, categories, delimiter))
 
-# Function to update the XML database with the tags
-def update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml):
-    # Check if the XML file exists
-    if os.path.exists(mytag_db_file):
-        tree = ET.parse(mytag_db_file)
-        root = tree.getroot()
-    else:
-        # If the XML file doesn't exist, create a new root element
-        root = ET.Element("MusicTags")
-        tree = ET.ElementTree(root)
-
-    # Process each file path and write its categorized tags to the XML
-    for file_path in file_paths:
-        if os.path.exists(file_path) and file_path.lower().endswith(('.flac', '.mp3')):
-            file_element = None
-            comments = []
-            
-            # Load the FLAC or MP3 file and get the comments
+# Function to write metadata field values to a FLAC or MP3 file, returning the size of the saved file or 0 if it was
+# left untouched. tags can be the file already loaded with load_tags.
+def write_metadata_values(file_path, values, tags=None):
+    if file_path.lower().endswith('.flac'):
+        return write_metadata_flac(file_path, values, tags)
+    elif file_path.lower().endswith('.mp3'):
+        return write_metadata_mp3(file_path, values, tags)
+    return 0
+
+class MyTagDatabase:
+    """MyTags XML database indexed by FilePath; changes are buffered and written atomically."""
+
+    def __init__(self, mytag_db_file, checkpoint_interval=0):
+        self.path = mytag_db_file
+        self.checkpoint_interval = checkpoint_interval  # Flush after this many changed songs (0 = only at the end)
+        self.dirty = 0
+
+        # Check if the XML file exists
+        if os.path.exists(mytag_db_file):
+            self.tree = ET.parse(mytag_db_file)
+            self.root = self.tree.getroot()
+        else:
+            # If the XML file doesn't exist, create a new root element
+            self.root = ET.Element("MusicTags")
+            self.tree = ET.ElementTree(self.root)
+            self.dirty = 1  # Make sure the new database gets written even if no song is added
+
+        # Build the FilePath -> Song index once so every lookup is a dict hit
+        self.songs = {}
+        for song in self.root.findall("Song"):
+            file_path_element = song.find("FilePath")
+            if file_path_element is not None and file_path_element.text:
+                self.songs.setdefault(file_path_element.text, song)
+
+    def update_song(self, file_path, categorized_tags, categories, replace=False):
+        """Merge a file's categorized tags into its Song element, adding the Song if it is new. With replace, tags
+        that are not in categorized_tags are removed from the categories as well."""
+        changed = False
+        file_element = self.songs.get(file_path)
+        if file_element is None:
+            # If the file is not in the XML, add a new Song element
+            file_element = ET.SubElement(self.root, "Song")
+            file_path_element = ET.SubElement(file_element, "FilePath")
+            file_path_element.text = file_path
+            self.songs[file_path] = file_element
+            changed = True
+
+        # Now, update the tags under each category in the XML
+        for category in categories:
+            category_element = file_element.find(category)
+            if category_element is None:
+                category_element = ET.SubElement(file_element, category)
+                changed = True
+
+            if replace:
+                for tag_element in category_element.findall("Tag"):
+                    if tag_element.text not in categorized_tags.get(category, []):
+                        category_element.remove(tag_element)
+                        changed = True
+                if not len(category_element):
+                    category_element.text = None  # Drop the indentation left by the removed tags, so it is written as <Category />
+
+            # Add tags to the category element if not already present
+            existing_tags = {tag_element.text for tag_element in category_element.findall("Tag")}
+            for tag in categorized_tags.get(category, []):
+                if tag not in existing_tags:
+                    tag_element = ET.SubElement(category_element, "Tag")
+                    tag_element.text = tag
+                    existing_tags.add(tag)
+                    changed = True
+
+        if changed:
+            self.dirty += 1
+            if self.checkpoint_interval and self.dirty >= self.checkpoint_interval:
+                self.flush()
+        return changed
+
+    def flush(self):
+        """Write buffered changes to disk atomically."""
+        if not self.dirty:
+            return
+        ET.indent(self.tree, '  ')
+        write_xml_atomic(self.tree, self.path)
+        self.dirty = 0
+
+    def close(self):
+        """Write any buffered changes; the XML database holds no open resources."""
+        self.flush()
+
+    def songs_with_tag(self, tag, category=None):
+        """Return the file paths of the songs that have a tag, optionally only in one category."""
+        return [file_path for file_path, song in self.songs.items()
+                if any(tag_element.text == tag for tag_element in song.findall(f"{category or '*'}/Tag"))]
+
+    def song_tags(self, file_path):
+        """Return a song's tags as {category: [tags]}, or None if the song is not in the database."""
+        song = self.songs.get(file_path)
+        if song is None:
+            return None
+        return {element.tag: [tag_element.text for tag_element in element.findall("Tag")] for element in song if element.tag != "FilePath"}
+
+    def iter_songs(self):
+        """Yield (file path, {category: [tags]}) for every song, in database order."""
+        for file_path in self.songs:
+            yield file_path, self.song_tags(file_path)
+
+    def export_xml(self, path):
+        """Write the database to path in the MusicTags XML format."""
+        ET.indent(self.tree, '  ')
+        write_xml_atomic(self.tree, path)
+
+SQLITE_HEADER = b'SQLite format 3\x00'  # First 16 bytes of every SQLite database file
+
+class SQLiteMyTagDatabase:
+    """MyTags database in SQLite with indexed songs, categories and tags; changes are committed in bulk transactions."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, file_path TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, category_id INTEGER NOT NULL REFERENCES categories (id),
+                                         name TEXT NOT NULL, UNIQUE (category_id, name));
+        CREATE TABLE IF NOT EXISTS song_categories (song_id INTEGER NOT NULL REFERENCES songs (id),
+                                                    category_id INTEGER NOT NULL REFERENCES categories (id),
+                                                    PRIMARY KEY (song_id, category_id));
+        CREATE TABLE IF NOT EXISTS song_tags (song_id INTEGER NOT NULL REFERENCES songs (id), tag_id INTEGER NOT NULL REFERENCES tags (id),
+                                              PRIMARY KEY (song_id, tag_id));
+        CREATE INDEX IF NOT EXISTS tags_name ON tags (name);
+        CREATE INDEX IF NOT EXISTS song_tags_tag ON song_tags (tag_id, song_id);
+    """
+
+    def __init__(self, mytag_db_file, checkpoint_interval=0):
+        self.path = mytag_db_file
+        self.checkpoint_interval = checkpoint_interval  # Commit after this many changed songs (0 = only at the end)
+        self.dirty = 0
+        self.connection = sqlite3.connect(mytag_db_file)
+        self.connection.executescript(self.SCHEMA)
+        self.connection.commit()
+        self.category_ids = {}  # Category name -> id
+        self.tag_ids = {}  # (category id, tag) -> id
+
+    def category_id(self, category):
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            self.connection.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (category,))
+            category_id = self.connection.execute("SELECT id FROM categories WHERE name = ?", (category,)).fetchone()[0]
+            self.category_ids[category] = category_id
+        return category_id
+
+    def tag_id(self, category_id, tag):
+        key = (category_id, tag)
+        tag_id = self.tag_ids.get(key)
+        if tag_id is None:
+            self.connection.execute("INSERT OR IGNORE INTO tags (category_id, name) VALUES (?, ?)", key)
+            tag_id = self.connection.execute("SELECT id FROM tags WHERE category_id = ? AND name = ?", key).fetchone()[0]
+            self.tag_ids[key] = tag_id
+        return tag_id
+
+    def update_song(self, file_path, categorized_tags, categories, replace=False):
+        """Merge a file's categorized tags into the database, adding the song if it is new. With replace, tags that
+        are not in categorized_tags are removed from the categories as well."""
+        execute = self.connection.execute
+        changed = False
+        row = execute("SELECT id FROM songs WHERE file_path = ?", (file_path,)).fetchone()
+        if row is None:
+            song_id = execute("INSERT INTO songs (file_path) VALUES (?)", (file_path,)).lastrowid
+            changed = True
+        else:
+            song_id = row[0]
+
+        # Rows that already exist are ignored, so rowcount tells whether anything was added
+        for category in categories:
+            category_id = self.category_id(category)
+            changed |= execute("INSERT OR IGNORE INTO song_categories (song_id, category_id) VALUES (?, ?)", (song_id, category_id)).rowcount > 0
+            if replace:
+                tags = categorized_tags.get(category, [])
+                changed |= execute(f"DELETE FROM song_tags WHERE song_id = ? AND tag_id IN "
+                                   f"(SELECT id FROM tags WHERE category_id = ? AND name NOT IN ({', '.join('?' * len(tags))}))",
+                                   (song_id, category_id, *tags)).rowcount > 0
+            for tag in categorized_tags.get(category, []):
+                tag_id = self.tag_id(category_id, tag)
+                changed |= execute("INSERT OR IGNORE INTO song_tags (song_id, tag_id) VALUES (?, ?)", (song_id, tag_id)).rowcount > 0
+
+        if changed:
+            self.dirty += 1
+            if self.checkpoint_interval and self.dirty >= self.checkpoint_interval:
+                self.flush()
+        return changed
+
+    def flush(self):
+        """Commit the changes made since the last flush in one transaction."""
+        self.connection.commit()
+        self.dirty = 0
+
+    def close(self):
+        """Commit any pending changes and close the database."""
+        self.flush()
+        self.connection.close()
+
+    def songs_with_tag(self, tag, category=None):
+        """Return the file paths of the songs that have a tag, optionally only in one category."""
+        query = ("SELECT DISTINCT songs.id, songs.file_path FROM tags JOIN song_tags ON song_tags.tag_id = tags.id JOIN songs ON songs.id = song_tags.song_id"
+                 " WHERE tags.name = ?")
+        parameters = [tag]
+        if category is not None:
+            query += " AND tags.category_id = (SELECT id FROM categories WHERE name = ?)"
+            parameters.append(category)
+        return [row[1] for row in self.connection.execute(query + " ORDER BY songs.id", parameters)]
+
+    def song_tags(self, file_path):
+        """Return a song's tags as {category: [tags]}, or None if the song is not in the database."""
+        rows = self.connection.execute(self.SONG_TAGS_QUERY.format(where="WHERE songs.file_path = ?"), (file_path,)).fetchall()
+        if not rows:
+            return None
+        song_tags = {}
+        for _, _, category, tag in rows:
+            if category is not None:
+                song_tags.setdefault(category, [])
+                if tag is not None:
+                    song_tags[category].append(tag)
+        return song_tags
+
+    # Every song with its categories and tags, in the order they were added (the same order the XML database keeps)
+    SONG_TAGS_QUERY = """
+        SELECT songs.id, songs.file_path, categories.name, song_tag.name FROM songs
+        LEFT JOIN song_categories ON song_categories.song_id = songs.id
+        LEFT JOIN categories ON categories.id = song_categories.category_id
+        LEFT JOIN (SELECT song_tags.rowid AS position, song_tags.song_id, tags.category_id, tags.name FROM song_tags
+                   JOIN tags ON tags.id = song_tags.tag_id) AS song_tag
+               ON song_tag.song_id = songs.id AND song_tag.category_id = song_categories.category_id
+        {where}
+        ORDER BY songs.id, song_categories.rowid, song_tag.position
+    """
+
+    def iter_songs(self):
+        """Yield (file path, {category: [tags]}) for every song, in database order, streaming one row at a time."""
+        song_id, file_path, song_tags = None, None, None
+        for row_song_id, row_file_path, category, tag in self.connection.execute(self.SONG_TAGS_QUERY.format(where="")):
+            if row_song_id != song_id:
+                if song_id is not None:
+                    yield file_path, song_tags
+                song_id, file_path, song_tags = row_song_id, row_file_path, {}
+            if category is not None:
+                song_tags.setdefault(category, [])
+                if tag is not None:
+                    song_tags[category].append(tag)
+        if song_id is not None:
+            yield file_path, song_tags
+
+    def export_xml(self, path):
+        """Write the database to path in the MusicTags XML format, streaming one row at a time."""
+        def write(f):
+            out = io.TextIOWrapper(f, encoding='utf-8', newline='\n')
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            rows = self.connection.execute(self.SONG_TAGS_QUERY.format(where=""))
+            row = next(rows, None)
+            if row is None:
+                out.write("<MusicTags />")
+            else:
+                out.write("<MusicTags>\n")
+                while row is not None:
+                    song_id = row[0]
+                    out.write(f"  <Song>\n    <FilePath>{escape(row[1])}</FilePath>\n")
+                    while row is not None and row[0] == song_id:
+                        category = row[2]
+                        tags = []
+                        while row is not None and row[0] == song_id and row[2] == category:
+                            if row[3] is not None:
+                                tags.append(row[3])
+                            row = next(rows, None)
+                        if category is None:
+                            continue
+                        if tags:
+                            out.write(f"    <{category}>\n" + ''.join(f"      <Tag>{escape(tag)}</Tag>\n" for tag in tags) + f"    </{category}>\n")
+                        else:
+                            out.write(f"    <{category} />\n")
+                    out.write("  </Song>\n")
+                out.write("</MusicTags>")
+            out.flush()
+            out.detach()
+        write_file_atomic(path, write)
+
+# Function to open the MyTag database in the format chosen by the 'mytag_db_format' config key
+# Function to check that an existing MyTag database file is in the configured format, so that pointing
+# "mytag_db_format": "sqlite" at the XML database from an earlier run (or the other way round) raises a ConfigError
+# that says what to change instead of a parse error from sqlite3 or ElementTree. New and empty files are fine.
+def check_mytag_database_format(mytag_db_file, db_format):
+    if not mytag_db_file or not os.path.isfile(mytag_db_file) or os.path.getsize(mytag_db_file) == 0:
+        return
+    with open(mytag_db_file, 'rb') as f:
+        is_sqlite = f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    if db_format == 'sqlite' and not is_sqlite:
+        raise ConfigError(f"{mytag_db_file} is not a SQLite database (it is probably the XML MyTag database of an earlier "
+                          f"run): set 'mytag_db_file' to a new file such as MyTags.sqlite, or 'mytag_db_format' to xml")
+    if db_format != 'sqlite' and is_sqlite:
+        raise ConfigError(f"{mytag_db_file} is a SQLite MyTag database: set 'mytag_db_format' to sqlite, or "
+                          f"'mytag_db_file' to a new file such as MyTags.xml")
+
+def open_mytag_database(mytag_db_file, checkpoint_interval=0, db_format='xml'):
+    if db_format == 'sqlite':
+        check_mytag_database_format(mytag_db_file, 'sqlite')
+        return SQLiteMyTagDatabase(mytag_db_file, checkpoint_interval)
+    elif db_format in (None, '', 'xml'):
+        check_mytag_database_format(mytag_db_file, 'xml')
+        return MyTagDatabase(mytag_db_file, checkpoint_interval)
+    raise ValueError(f"Unknown MyTag database format: {db_format} (expected 'xml' or 'sqlite')")
+
+# Function to flatten a list of comments where some entries are themselves lists of strings
+def flatten_comments(comments):
+    flattened_comments = []
+    for comment in comments:
+        if isinstance(comment, list):
+            flattened_comments.extend(comment)  # If it's a list, extend the list
+        else:
+            flattened_comments.append(comment)  # Otherwise, just append it as-is
+    return flattened_comments
+
+# Function to get the comments from a loaded FLAC file or ID3 tag
+def comments_from_tags(tags):
+    load_mutagen()
+    if isinstance(tags, ID3):
+        # Extract all 'COMM' frames and get the text from them
+        return flatten_comments([frame.text for frame in tags.getall('COMM')])
+    return flatten_comments(tags.get('comment', []))
+
+# Function to read the comment strings from a FLAC or MP3 file
+def read_comments(file_path):
+    # Parse just the tag header when possible so cover art is never read
+    header_tags = read_header_tags(file_path)
+    if header_tags is not None:
+        return header_tags.comments
+
+    # Load the FLAC or MP3 file and get the comments
+    if file_path.lower().endswith(('.flac', '.mp3')):
+        return comments_from_tags(load_tags(file_path))
+    return []
+
+# Function to load the tags of a FLAC or MP3 file into Mutagen: the FLAC file, or its ID3 tag
+def load_tags(file_path):
+    load_mutagen()
+    if file_path.lower().endswith('.flac'):
+        return FLAC(file_path)
+    return load_id3(file_path)
+
+# Function to read the current values of a metadata field from tags loaded with load_tags (None if the field is not set)
+def read_tag_field(tags, metadata_field):
+    load_mutagen()
+    if isinstance(tags, ID3):
+        return read_id3_field(tags, metadata_field)
+    return read_flac_field(tags, metadata_field)
+
+class HeaderTags:
+    """Comments and text fields parsed straight from a file's tag header, without loading pictures or audio info."""
+
+    def __init__(self, file_path, comments, fields):
+        self.file_path = file_path
+        self.comments = comments
+        self.fields = fields  # FLAC: upper case Vorbis key -> values, MP3: frame hash key -> values
+
+    def field(self, metadata_field):
+        """Return the current values of a metadata field (None if not set), using the same mapping as the writers."""
+        if self.file_path.lower().endswith('.flac'):
+            return self.fields.get(flac_field_name(metadata_field).upper())
+        kind, target = resolve_id3_field(metadata_field)
+        if kind == 'easy':
+            key = easy_id3_frame_key(target)
+        elif kind == 'frame':
+            key = target.__name__
+        elif kind == 'TXXX':
+            key = f'TXXX:{target}'
+        else:
+            key = kind
+        return self.fields.get(key)
+
+# Function to find the ID3 frame an EasyID3 key writes to, by letting EasyID3 set it on an empty tag
+@functools.lru_cache(maxsize=None)
+def easy_id3_frame_key(key):
+    load_mutagen()
+    tags = ID3()
+    EasyID3.Set[key](tags, key, ['x'])
+    return next(iter(tags.keys()), None)
+
+# Function to parse just the tag header of a FLAC or MP3 file. Picture blocks, APIC frames and audio data are seeked
+# over, never read. Returns None for anything unusual (ID3 unsynchronisation, compressed frames, an ID3v1 comment,
+# ...), in which case the caller falls back to Mutagen.
+def read_header_tags(file_path):
+    try:
+        with open(file_path, 'rb') as f:
             if file_path.lower().endswith('.flac'):
-                audio = FLAC(file_path)
-                comments = audio.get('comment', [])
+                return _read_flac_header(file_path, f)
             elif file_path.lower().endswith('.mp3'):
-                audio = MP3(file_path, ID3=ID3)
-                # Extract all 'COMM' frames and get the text from them
-                comments = [frame.text for frame in audio.tags.getall('COMM')]  # Extract comments from MP3
-
-            # Flatten the list of comments (if any)
-            flattened_comments = []
-            for comment in comments:
-                if isinstance(comment, list):
-                    flattened_comments.extend(comment)  # If it's a list, extend the list
+                return _read_id3_header(file_path, f)
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+    return None
+
+def _read_flac_header(file_path, f):
+    if f.read(4) != b'fLaC':
+        return None  # e.g. an ID3 tag in front of the FLAC stream
+    while True:
+        block_header = f.read(4)
+        if len(block_header) < 4:
+            return None
+        last, block_type, length = block_header[0] & 0x80, block_header[0] & 0x7F, int.from_bytes(block_header[1:4], 'big')
+        if block_type == 4:  # VORBIS_COMMENT
+            return _parse_vorbis_comment(file_path, f.read(length))
+        f.seek(length, os.SEEK_CUR)
+        if last:
+            return HeaderTags(file_path, [], {})
+
+def _parse_vorbis_comment(file_path, data):
+    vendor_length = struct.unpack_from('<I', data, 0)[0]
+    offset = 4 + vendor_length
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    fields = {}
+    for _ in range(count):
+        length = struct.unpack_from('<I', data, offset)[0]
+        entry = data[offset + 4:offset + 4 + length].decode('utf-8', 'replace')
+        offset += 4 + length
+        key, separator, value = entry.partition('=')
+        if separator:
+            fields.setdefault(key.upper(), []).append(value)
+    return HeaderTags(file_path, fields.get('COMMENT', []), fields)
+
+ID3_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+ID3_FRAME_ID = re.compile(rb'^[A-Z0-9]{3,4}$')
+
+def _split_id3_terminated(encoding, data):
+    # Split off a null terminated string; UTF-16 strings end in two null bytes on an even offset
+    if encoding in (1, 2):
+        for index in range(0, len(data) - 1, 2):
+            if data[index:index + 2] == b'\0\0':
+                return data[:index], data[index + 2:]
+        return data, b''
+    head, _, tail = data.partition(b'\0')
+    return head, tail
+
+def _decode_id3_strings(encoding, data):
+    values = [value.lstrip('\ufeff') for value in data.decode(ID3_ENCODINGS[encoding], 'replace').split('\0')]
+    while values and values[-1] == '':
+        values.pop()
+    return values
+
+def _syncsafe_int(data):
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7F)
+    return value
+
+def _read_id3_header(file_path, f):
+    # Mutagen also merges in an ID3v1 comment, so let it handle files that have one
+    if os.fstat(f.fileno()).st_size >= 128:
+        f.seek(-128, os.SEEK_END)
+        tail = f.read(128)
+        if tail[:3] == b'TAG' and tail[97:127].strip(b'\0 '):
+            return None
+        f.seek(0)
+
+    header = f.read(10)
+    if header[:3] != b'ID3':
+        return HeaderTags(file_path, [], {})  # No ID3v2 tag at the start of the file
+    if len(header) < 10:
+        return None
+    major, flags = header[3], header[5]
+    if major not in (2, 3, 4) or flags & 0xC0:  # Unsynchronised tags and extended headers are left to Mutagen
+        return None
+    tag_size = _syncsafe_int(header[6:10])
+
+    id_length, header_length = (3, 6) if major == 2 else (4, 10)
+    comments, fields = {}, {}
+    position = 0
+    while position + header_length <= tag_size:
+        frame_header = f.read(header_length)
+        frame_id = frame_header[:id_length]
+        if frame_id[:1] == b'\0':
+            break  # Padding
+        if not ID3_FRAME_ID.match(frame_id):
+            return None
+        size_bytes = frame_header[id_length:id_length + (3 if major == 2 else 4)]
+        if major == 4:
+            frame_size = _syncsafe_int(size_bytes)
+        else:
+            frame_size = int.from_bytes(size_bytes, 'big')
+        frame_flags = frame_header[9] if major != 2 else 0
+        position += header_length + frame_size
+        if position > tag_size:
+            return None
+        frame_id = frame_id.decode('ascii')
+        if major == 2 and frame_id[0] == 'T':
+            return None  # ID3v2.2 text frames have different IDs (TCO, TCM, ...), so let Mutagen translate them
+
+        if frame_id in ('COMM', 'COM') or frame_id[0] == 'T':
+            if frame_flags & (0xE0 if major == 3 else 0x4F):  # Compressed, encrypted, grouped or unsynchronised frame
+                return None
+            data = f.read(frame_size)
+            if not data or data[0] not in ID3_ENCODINGS:
+                continue
+            encoding = data[0]
+            if frame_id in ('COMM', 'COM'):
+                description, text = _split_id3_terminated(encoding, data[4:])
+                key = (_decode_id3_strings(encoding, description) or [''])[0], data[1:4]
+                comments.setdefault(key, []).extend(_decode_id3_strings(encoding, text))
+            elif frame_id == 'TXXX':
+                description, text = _split_id3_terminated(encoding, data[1:])
+                key = f"TXXX:{(_decode_id3_strings(encoding, description) or [''])[0]}"
+                fields.setdefault(key, []).extend(_decode_id3_strings(encoding, text))
+            else:
+                fields.setdefault(frame_id, []).extend(_decode_id3_strings(encoding, data[1:]))
+        else:
+            f.seek(frame_size, os.SEEK_CUR)  # Pictures and other binary frames are never read
+
+    all_comments = [text for texts in comments.values() for text in texts]
+    if comments:
+        fields['COMM'] = all_comments
+    return HeaderTags(file_path, all_comments, fields)
+
+class RunProfile:
+    """Time and call counts per phase of a run; safe to update from the worker threads."""
+
+    PHASES = ('scan', 'read', 'categorize', 'db_update', 'metadata_write', 'collection_write')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block and add it to the named phase."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, adding the time spent producing each item to the named phase."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, amount=1):
+        """Add to a named counter."""
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        """Return the timings and counters as plain data."""
+        return {
+            'wall_seconds': time.perf_counter() - self.started,
+            'phases': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in self.seconds},
+            'counters': dict(self.counters),
+        }
+
+    def format_table(self):
+        """Return the timings as a text table. Phases that run on worker threads add up the time of every thread."""
+        wall = time.perf_counter() - self.started
+        lines = [f"{'Phase':<18}{'Seconds':>10}{'Calls':>10}{'ms/call':>10}{'% wall':>8}"]
+        for name in self.seconds:
+            seconds, calls = self.seconds[name], self.calls[name]
+            per_call = seconds * 1000 / calls if calls else 0.0
+            share = seconds * 100 / wall if wall else 0.0
+            lines.append(f"{name:<18}{seconds:>10.3f}{calls:>10}{per_call:>10.2f}{share:>7.1f}%")
+        lines.append(f"{'wall time':<18}{wall:>10.3f}")
+        for name, value in self.counters.items():
+            lines.append(f"{name:<18}{value:>10}")
+        return "\n".join(lines)
+
+# Shared disabled profile used when a run is not being profiled
+NO_PROFILE = RunProfile(enabled=False)
+
+# Result of processing one file: status is 'new', 'updated', 'skipped' or 'resumed'; read/bytes_written tell whether the
+# file was opened and how large it was when saved (0 if no field needed changing); changes maps each metadata field
+# that was rewritten to {'old': the values it held before (None if it was not set), 'new': the value written}
+FileResult = namedtuple('FileResult', ['file_path', 'status', 'categorized_tags', 'size', 'mtime_ns', 'comment_hash', 'read', 'bytes_written',
+                                       'changes'],
+                        defaults=[False, 0, None])
+
+class ScanState:
+    """Size, mtime and comment hash of every processed file, kept next to the MyTags database between runs."""
+
+    VERSION = 1
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint  # Hash of the settings that affect categorization; a change invalidates the cache
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            if data.get('version') == self.VERSION and data.get('fingerprint') == fingerprint:
+                self.entries = data.get('files', {})
+
+    @staticmethod
+    def path_for(mytag_db_file):
+        """Return the scan state path that belongs to a MyTags database file."""
+        return os.path.splitext(mytag_db_file)[0] + '.scanstate.json'
+
+    @staticmethod
+    def fingerprint_for(categorizer, delimiter):
+        """Hash the categories, matching options and delimiter so cached results are only reused with the same settings."""
+        settings = json.dumps({'categories': categorizer.categories, 'options': categorizer.options, 'delimiter': delimiter}, sort_keys=True)
+        return hashlib.sha1(settings.encode('utf-8')).hexdigest()
+
+    def get(self, file_path):
+        """Return the cached entry for a file, or None if it has not been seen before."""
+        return self.entries.get(file_path)
+
+    def record(self, result):
+        """Remember the state of a processed file."""
+        self.entries[result.file_path] = {
+            'size': result.size,
+            'mtime_ns': result.mtime_ns,
+            'comment_hash': result.comment_hash,
+            'tags': result.categorized_tags,
+        }
+
+    def save(self):
+        """Write the scan state to disk atomically."""
+        write_json_atomic({'version': self.VERSION, 'fingerprint': self.fingerprint, 'files': self.entries}, self.path)
+
+class RunJournal:
+    """Append-only JSON Lines journal of the files a run has finished, kept next to the MyTags database.
+
+    The first line describes the run, then there is one line per finished file with its tags, whether it was
+    written and the old values of the fields that changed, and a last line once everything has been saved. Files are
+    recorded by the worker that processed them as soon as they are done and lines are flushed as they are written, so
+    after a crash the journal shows exactly which files were already done.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.file = None
+        self.lock = threading.Lock()  # Worker threads append their files concurrently
+
+    @staticmethod
+    def path_for(mytag_db_file):
+        """Return the journal path that belongs to a MyTags database file."""
+        return os.path.splitext(mytag_db_file)[0] + '.journal.jsonl'
+
+    @staticmethod
+    def read(path):
+        """Return (header, file entries, finished) from a journal file; a torn last line is ignored."""
+        header, entries, finished = None, {}, False
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # The run stopped in the middle of this line
+                if 'run' in record:
+                    header = record
+                elif 'finished' in record:
+                    finished = True
+                elif 'path' in record:
+                    entries[record['path']] = record
+        return header, entries, finished
+
+    @classmethod
+    def latest_with_changes(cls, path):
+        """Return the journal (path or its .prev) of the last run that modified files, or None if neither did."""
+        for candidate in (path, path + '.prev'):
+            if os.path.exists(candidate) and any(entry.get('written') for entry in cls.read(candidate)[1].values()):
+                return candidate
+        return None
+
+    def start(self, resume=False, log=print):
+        """Open the journal for this run. With resume, return the entries of an unfinished earlier run with the same
+        settings so their files do not have to be processed again. Otherwise an earlier journal that modified files is
+        kept as .prev, so a run that changes nothing does not lose the rollback data of the last one that did."""
+        resumed = {}
+        entries = {}
+        if os.path.exists(self.path):
+            header, entries, finished = self.read(self.path)
+            if resume and not finished and header and header.get('version') == self.VERSION and header.get('fingerprint') == self.fingerprint:
+                resumed = entries
+            elif resume:
+                log("Nothing to resume: the last run finished or used different settings")
+        if resumed:
+            log(f"Resuming an interrupted run: {len(resumed)} files already done")
+            self.file = open(self.path, 'a', encoding='utf-8')
+        else:
+            if any(entry.get('written') for entry in entries.values()):
+                os.replace(self.path, self.path + '.prev')
+            self.file = open(self.path, 'w', encoding='utf-8')
+            self.write({'run': time.strftime('%Y-%m-%dT%H:%M:%S'), 'version': self.VERSION, 'fingerprint': self.fingerprint})
+        return resumed
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()  # Hand the line to the OS right away, so it survives the process being killed
+
+    def record(self, result):
+        """Append the result of a finished file."""
+        self.write({
+            'path': result.file_path,
+            'status': result.status,
+            'tags': result.categorized_tags,
+            'written': bool(result.bytes_written),
+            'changes': result.changes or {},
+            'size': result.size,
+            'mtime_ns': result.mtime_ns,
+            'comment_hash': result.comment_hash,
+        })
+
+    def finish(self, summary):
+        """Mark the run as finished once all of its results have been saved, and close the journal."""
+        self.write({'finished': True, **{key: summary[key] for key in ('new', 'updated', 'skipped', 'resumed', 'files_written', 'cancelled')}})
+        os.fsync(self.file.fileno())
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Function to turn a journal entry from an interrupted run back into the result of its file
+def result_from_journal(entry):
+    return FileResult(entry['path'], 'resumed', entry['tags'], entry['size'], entry['mtime_ns'], entry['comment_hash'],
+                      changes=entry.get('changes'))
+
+# Function to build a rollback report from a run journal: a change plan, in the same format as --plan, that lists
+# every file the run rewrote and sets each changed field back to its old values. Applying it with --apply-plan undoes
+# the run's metadata changes: multi-valued fields get all their values back and fields that did not exist before are
+# removed ('new' is None).
+def rollback_report(journal_path):
+    header, entries, finished = RunJournal.read(journal_path)
+    files = []
+    for entry in entries.values():
+        if entry.get('written'):
+            files.append({'path': entry['path'], 'changes': [
+                {'target': 'metadata', 'field': field, 'old': change['new'], 'new': change['old']}
+                for field, change in entry['changes'].items()
+            ]})
+    return {'version': 1, 'run': header.get('run') if header else None, 'finished': finished, 'files': files}
+
+# Function to hash the comments of a file so unchanged MyTags can be detected on later runs
+def hash_comments(comments):
+    return hashlib.sha1('\0'.join(comments).encode('utf-8')).hexdigest()
+
+# Function to read, categorize and write the metadata of a single file; safe to run from worker threads
+def process_file(file_path, categories, delimiter, previous=None, force=False, categorizer=None, profile=NO_PROFILE):
+    if not (os.path.exists(file_path) and file_path.lower().endswith(('.flac', '.mp3'))):
+        return None
+
+    # Files whose size and mtime match the last run are skipped without opening them at all
+    stat = os.stat(file_path)
+    if previous and not force and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return FileResult(file_path, 'skipped', previous['tags'], stat.st_size, stat.st_mtime_ns, previous['comment_hash'])
+
+    # Categorize the tags from the comments. The header-only read also gives the current field values, so a file whose
+    # fields are already up to date is never loaded into Mutagen at all.
+    # When the header cannot be parsed the file is loaded into Mutagen once, for the comments, the current field values
+    # and the write.
+    with profile.phase('read'):
+        header_tags = read_header_tags(file_path)
+        tags = load_tags(file_path) if header_tags is None else None
+        comments = header_tags.comments if header_tags is not None else comments_from_tags(tags)
+    with profile.phase('categorize'):
+        comment_hash = hash_comments(comments)
+        categorized_tags = process_comments(comments, categorizer or categories)
+
+    # The file was touched but its MyTags are the same, so there is nothing to write
+    if previous and not force and previous['comment_hash'] == comment_hash:
+        return FileResult(file_path, 'skipped', categorized_tags, stat.st_size, stat.st_mtime_ns, comment_hash, True)
+
+    # Now, update the metadata field in the FLAC or MP3 file, remembering what the changed fields held before
+    bytes_written = 0
+    changes = {}
+    values = build_metadata_values(categorized_tags, categories, delimiter)
+    if values:
+        current_values = read_field_values(file_path, values, header_tags, tags)
+        changes = {field: {'old': current_values[field], 'new': tag_str} for field, tag_str in values.items() if current_values[field] != [tag_str]}
+    if changes:
+        with profile.phase('metadata_write'):
+            bytes_written = write_metadata_values(file_path, values, tags)
+
+    # Record the state after our own write so the next run sees the file as unchanged
+    if bytes_written:
+        stat = os.stat(file_path)
+    return FileResult(file_path, 'updated' if previous else 'new', categorized_tags, stat.st_size, stat.st_mtime_ns, comment_hash, True, bytes_written,
+                      changes if bytes_written else {})
+
+# Function to read the current values of metadata fields from already parsed header tags, or through Mutagen when the
+# header could not be parsed (header_tags is None), reusing tags if the file was already loaded with load_tags
+def read_field_values(file_path, fields, header_tags, tags=None):
+    if header_tags is not None:
+        return {field: header_tags.field(field) for field in fields}
+    if tags is None:
+        tags = load_tags(file_path)
+    return {field: read_tag_field(tags, field) for field in fields}
+
+# Function to run an iterator in a background thread so producing the next items overlaps with consuming the
+# current ones. At most maxsize items are buffered; when the buffer is full the producer waits (backpressure).
+def prefetch(items, maxsize):
+    if maxsize <= 0:
+        yield from items
+        return
+
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+    finished = object()
+
+    def put(entry):
+        # Give up if the consumer has gone away, instead of blocking on a full buffer forever
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except BaseException as e:
+            put((finished, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+# Function to map func over items with a pool of worker threads, yielding results in input order
+def ordered_map(func, items, workers, max_pending=None):
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # Only keep a bounded number of files in flight so a huge library is never queued up all at once
+    max_pending = max_pending or workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # If the consumer stops early (e.g. the run was cancelled) drop the files that have not started yet
+            for future in pending:
+                future.cancel()
+
+# Function to update the XML database with the tags
+def update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml, checkpoint_interval=0, workers=1, force_rescan=False,
+               progress_callback=None, cancel_event=None, total=None, log=print, profile=NO_PROFILE, db_format='xml', queue_size=256,
+               spill_threshold=10000, resume=False):
+    # categories can be the raw config dict or an already compiled Categorizer
+    categorizer = categories if isinstance(categories, Categorizer) else Categorizer(categories)
+    categories = categorizer.categories
+
+    # MyTag database changes are buffered and only written at checkpoints and at the end of the run
+    database = open_mytag_database(mytag_db_file, checkpoint_interval, db_format)
+
+    # All TRACK updates are collected here and written to the Rekordbox XML in a single pass at the end
+    collection = RekordboxCollection(rekordbox_db_path, spill_threshold) if use_rekordbox_xml else None
+
+    # What every file looked like after the last run, used to skip files that have not changed since
+    scan_state = ScanState(ScanState.path_for(mytag_db_file), ScanState.fingerprint_for(categorizer, delimiter))
+    summary = {'new': 0, 'updated': 0, 'skipped': 0, 'resumed': 0, 'files_read': 0, 'files_written': 0, 'bytes_written': 0, 'cancelled': False}
+
+    # Every finished file is appended to the journal by its worker straight after it was written, before its result
+    # reaches the databases, so the journal lists every file that was modified. Files an interrupted run already
+    # finished are taken from its journal when resuming, so only their results are saved again, without reading the files.
+    journal = RunJournal(RunJournal.path_for(mytag_db_file), scan_state.fingerprint)
+    resumed = journal.start(resume, log)
+
+    if total is None and hasattr(file_paths, '__len__'):
+        total = len(file_paths)
+    start = time.perf_counter()
+    done = 0
+
+    # The run is a pipeline of bounded stages that overlap: scanning runs ahead in its own thread, reading,
+    # categorizing and metadata writing run in the worker pool, and the databases are only touched here, one file at
+    # a time and in input order, so the output is the same for any worker count. Each queue between the stages holds
+    # at most queue_size files, so memory use does not grow with the size of the library.
+    def work(file_path):
+        if file_path in resumed:
+            return file_path, result_from_journal(resumed[file_path])
+        result = process_file(file_path, categories, delimiter, scan_state.get(file_path), force_rescan, categorizer, profile)
+        if result is not None:
+            journal.record(result)
+        return file_path, result
+
+    scanned = prefetch(profile.timed_iter('scan', file_paths), queue_size)
+    results = ordered_map(work, scanned, workers, max(workers, queue_size))
+    try:
+        for file_path, result in results:
+            done += 1
+            if result is not None:
+                summary[result.status] += 1
+                summary['files_read'] += result.read
+                summary['files_written'] += bool(result.bytes_written)
+                summary['bytes_written'] += result.bytes_written
+                scan_state.record(result)
+
+                with profile.phase('db_update'):
+                    database.update_song(result.file_path, result.categorized_tags, categories)
+
+                if collection is not None:
+                    collection.stage(result.file_path, build_rekordbox_attributes(result.categorized_tags, categories, delimiter)) # After updating the FLAC or MP3 metadata, queue the tags for the songs TRACK element in the original Rekordbox XML if use_rekordbox_xml is enabled
+
+            if progress_callback is not None:
+                elapsed = time.perf_counter() - start
+                progress_callback(done, total, file_path, done / elapsed if elapsed else 0.0)
+
+            # Stop between files; everything finished so far is still saved below
+            if cancel_event is not None and cancel_event.is_set():
+                summary['cancelled'] = True
+                break
+    except BaseException:
+        results.close()  # Let the files in progress finish and be journaled
+        journal.close()  # Left unfinished, so the run can be resumed
+        raise
+    finally:
+        results.close()
+        scanned.close()
+
+    with profile.phase('db_update'):
+        database.close()
+        scan_state.save()
+    if summary['cancelled']:
+        log(f"Run cancelled after {done} files")
+    log(f"Files processed: {summary['new']} new, {summary['updated']} updated, {summary['skipped']} skipped (unchanged)"
+        + (f", {summary['resumed']} resumed from the journal" if summary['resumed'] else ""))
+    # Saved files are counted at their full size, so bytes rewritten is an upper bound
+    log(f"Files read: {summary['files_read']}, files written: {summary['files_written']}, bytes rewritten: {summary['bytes_written']}")
+
+    if collection is not None:
+        with profile.phase('collection_write'):
+            updated_tracks = collection.commit()
+        collection.log_commit(updated_tracks, log)
+    journal.finish(summary)
+
+    summary['seconds'] = time.perf_counter() - start
+    if profile.enabled:
+        for name in ('new', 'updated', 'skipped', 'resumed', 'files_read', 'files_written', 'bytes_written'):
+            profile.count(name, summary[name])
+        summary['profile'] = profile.as_dict()
+        log("\nProfile:\n" + profile.format_table())
+    return summary
+
+# Function to work out which metadata fields of a single file would change, without writing anything; safe to run from worker threads
+def plan_file(file_path, categories, delimiter, previous=None, force=False, categorizer=None):
+    if not (os.path.exists(file_path) and file_path.lower().endswith(('.flac', '.mp3'))):
+        return None
+
+    # A file that has not changed since our last write already holds the values we would write
+    stat = os.stat(file_path)
+    if previous and not force and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous['tags'], []
+
+    # Load the tags once and use them both for the comments and for the current field values
+    header_tags = read_header_tags(file_path)
+    if header_tags is not None:
+        comments, read_field = header_tags.comments, lambda metadata_field: header_tags.field(metadata_field)
+    else:
+        tags = load_tags(file_path)
+        comments, read_field = comments_from_tags(tags), lambda metadata_field: read_tag_field(tags, metadata_field)
+    categorized_tags = process_comments(comments, categorizer or categories)
+
+    changes = []
+    for metadata_field, tag_str in build_metadata_values(categorized_tags, categories, delimiter).items():
+        current = read_field(metadata_field)
+        if current != [tag_str]:
+            changes.append({'target': 'metadata', 'field': metadata_field, 'old': '; '.join(current or []), 'new': tag_str})
+    return categorized_tags, changes
+
+# Function to build a change plan: every file and field a run would change, computed without touching any file
+def plan_update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml, workers=1, force_rescan=False,
+                    progress_callback=None, cancel_event=None, total=None):
+    categorizer = categories if isinstance(categories, Categorizer) else Categorizer(categories)
+    categories = categorizer.categories
+    scan_state = ScanState(ScanState.path_for(mytag_db_file), ScanState.fingerprint_for(categorizer, delimiter))
+
+    # Current TRACK attribute values, read once in a streaming pass
+    rekordbox_fields = [info.get('rekordbox_field') for info in categories.values() if info.get('rekordbox_field')]
+    current_attributes = RekordboxCollection(rekordbox_db_path).read_attributes(rekordbox_fields) if use_rekordbox_xml else {}
+
+    if total is None and hasattr(file_paths, '__len__'):
+        total = len(file_paths)
+    start = time.perf_counter()
+    plan = {'version': 1, 'files': []}
+    done = 0
+
+    def work(file_path):
+        return file_path, plan_file(file_path, categories, delimiter, scan_state.get(file_path), force_rescan, categorizer)
+
+    results = ordered_map(work, file_paths, workers)
+    try:
+        for file_path, result in results:
+            done += 1
+            if result is not None:
+                categorized_tags, changes = result
+                if use_rekordbox_xml and file_path in current_attributes:
+                    for field, value in build_rekordbox_attributes(categorized_tags, categories, delimiter).items():
+                        old = current_attributes[file_path].get(field)
+                        if old != value:
+                            changes.append({'target': 'rekordbox', 'field': field, 'old': old or '', 'new': value})
+                if changes:
+                    plan['files'].append({'path': file_path, 'tags': categorized_tags, 'changes': changes})
+
+            if progress_callback is not None:
+                elapsed = time.perf_counter() - start
+                progress_callback(done, total, file_path, done / elapsed if elapsed else 0.0)
+            if cancel_event is not None and cancel_event.is_set():
+                plan['cancelled'] = True
+                break
+    finally:
+        results.close()
+
+    plan['files_checked'] = done
+    return plan
+
+# Function to save a change plan as JSON, or as a flat CSV (one row per changed field) if the path ends in .csv
+def save_plan(plan, plan_path):
+    if plan_path.lower().endswith('.csv'):
+        def write_csv(f):
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            # action is 'set' for a single value, 'set_list' when new holds a JSON list of values and 'delete' to
+            # remove the field
+            writer.writerow(['path', 'target', 'field', 'old', 'new', 'action'])
+            for entry in plan['files']:
+                for change in entry['changes']:
+                    old, new = change['old'], change['new']
+                    if new is None:
+                        action, new = 'delete', ''
+                    elif isinstance(new, str):
+                        action = 'set'
+                    else:
+                        action, new = 'set_list', json.dumps(new, ensure_ascii=False)
+                    old = '; '.join(old) if isinstance(old, list) else old or ''
+                    writer.writerow([entry['path'], change['target'], change['field'], old, new, action])
+            text.flush()
+            text.detach()
+        write_file_atomic(plan_path, write_csv)
+    else:
+        write_json_atomic(plan, plan_path)
+
+# Function to load a change plan saved by save_plan
+def load_plan(plan_path):
+    if not plan_path.lower().endswith('.csv'):
+        with open(plan_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    files = {}
+    with open(plan_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            entry = files.setdefault(row['path'], {'path': row['path'], 'changes': []})
+            action = row.get('action') or 'set'  # Plans saved before the action column only set single values
+            new = None if action == 'delete' else json.loads(row['new']) if action == 'set_list' else row['new']
+            entry['changes'].append({'target': row['target'], 'field': row['field'], 'old': row['old'], 'new': new})
+    return {'version': 1, 'files': list(files.values())}
+
+# Function to apply a saved change plan: only the files and fields listed in it are written
+def apply_plan(plan, mytag_db_file, rekordbox_db_path, categories, use_rekordbox_xml, checkpoint_interval=0, workers=1, log=print, db_format='xml'):
+    categories = categories.categories if isinstance(categories, Categorizer) else categories
+    database = open_mytag_database(mytag_db_file, checkpoint_interval, db_format)
+    collection = RekordboxCollection(rekordbox_db_path) if use_rekordbox_xml else None
+
+    def work(entry):
+        values = {change['field']: change['new'] for change in entry['changes'] if change['target'] == 'metadata'}
+        if values and os.path.exists(entry['path']):
+            return entry, write_metadata_values(entry['path'], values)
+        return entry, 0
+
+    files_written = 0
+    for entry, bytes_written in ordered_map(work, plan['files'], workers):
+        files_written += bool(bytes_written)
+        if entry.get('tags') is not None:
+            database.update_song(entry['path'], entry['tags'], categories)
+        if collection is not None:
+            collection.stage(entry['path'], {change['field']: change['new'] for change in entry['changes'] if change['target'] == 'rekordbox'})
+
+    database.close()
+    log(f"Plan applied: {files_written} files written")
+    if collection is not None:
+        updated_tracks = collection.commit()
+        collection.log_commit(updated_tracks, log)
+    return files_written
+
+# Function to read and categorize files without writing anything, yielding (file path, categorized tags) in input order
+def iter_categorized_files(file_paths, categories, workers=1):
+    categorizer = categories if isinstance(categories, Categorizer) else Categorizer(categories)
+
+    def work(file_path):
+        if not (os.path.exists(file_path) and file_path.lower().endswith(('.flac', '.mp3'))):
+            return file_path, None
+        return file_path, process_comments(read_comments(file_path), categorizer)
+
+    for file_path, categorized_tags in ordered_map(work, file_paths, workers):
+        if categorized_tags is not None:
+            yield file_path, categorized_tags
+
+# Function to export categorized tags to a flat file, picking the format from the extension of export_path:
+#   .csv      one row per file: path, then one column per category with its tags joined by the delimiter
+#   .jsonl    one JSON object per file: {"path": ..., "tags": {category: [tags]}}
+#   .parquet  the same columns as the CSV in a Parquet file (needs pyarrow)
+#   .json     the same columns as the CSV as columnar JSON: {"columns": [...], "data": {column: [values]}}
+# rows is a function returning an iterator of (file path, {category: [tags]}), e.g. database.iter_songs. Every format
+# is written in a single streaming pass over the rows. Returns the number of files exported.
+def export_tags(rows, categories, export_path, delimiter, log=print):
+    columns = list(categories)
+    extension = os.path.splitext(export_path)[1].lower()
+    count = 0
+
+    def flat_values(categorized_tags):
+        return [delimiter.join(categorized_tags.get(category, [])) for category in columns]
+
+    if extension == '.parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            export_path = os.path.splitext(export_path)[0] + '.json'
+            extension = '.json'
+            log(f"pyarrow is not installed, writing columnar JSON to {export_path} instead of Parquet")
+
+    def write(f):
+        nonlocal count
+        if extension == '.csv':
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            writer.writerow(['path'] + columns)
+            for file_path, categorized_tags in rows():
+                writer.writerow([file_path] + flat_values(categorized_tags))
+                count += 1
+            text.flush()
+            text.detach()
+        elif extension == '.jsonl':
+            for file_path, categorized_tags in rows():
+                f.write((json.dumps({'path': file_path, 'tags': categorized_tags}, ensure_ascii=False) + '\n').encode('utf-8'))
+                count += 1
+        elif extension == '.parquet':
+            schema = pyarrow.schema([(column, pyarrow.string()) for column in ['path'] + columns])
+            with pyarrow.parquet.ParquetWriter(f, schema) as writer:
+                batch = []
+                for file_path, categorized_tags in rows():
+                    batch.append([file_path] + flat_values(categorized_tags))
+                    count += 1
+                    if len(batch) >= 10000:
+                        writer.write_table(pyarrow.Table.from_pylist([dict(zip(schema.names, row)) for row in batch], schema))
+                        batch = []
+                if batch or not count:
+                    writer.write_table(pyarrow.Table.from_pylist([dict(zip(schema.names, row)) for row in batch], schema))
+        elif extension == '.json':
+            # Each column is buffered in its own temporary file during the single pass over the rows and the buffers
+            # are joined at the end, so no column has to be held in memory
+            names = ['path'] + columns
+            buffers = [tempfile.TemporaryFile() for _ in names]
+            try:
+                for file_path, categorized_tags in rows():
+                    for buffer, value in zip(buffers, [file_path] + flat_values(categorized_tags)):
+                        buffer.write((b', ' if count else b'') + json.dumps(value, ensure_ascii=False).encode('utf-8'))
+                    count += 1
+                f.write(json.dumps({'columns': names})[:-1].encode('utf-8') + b', "data": {')
+                for index, (column, buffer) in enumerate(zip(names, buffers)):
+                    f.write((b', ' if index else b'') + json.dumps(column).encode('utf-8') + b': [')
+                    buffer.seek(0)
+                    shutil.copyfileobj(buffer, f)
+                    f.write(b']')
+                f.write(b'}}')
+            finally:
+                for buffer in buffers:
+                    buffer.close()
+        else:
+            raise ValueError(f"Unknown export format: {export_path} (use .csv, .jsonl, .parquet or .json)")
+
+    write_file_atomic(export_path, write)
+    log(f"Exported the tags of {count} files to {export_path}")
+    return count
+
+# Function to read an edited tag export (CSV with a path column and one column per category) as
+# (file path, categorized tags). Cells are split on the delimiter exactly as configured, so tags containing part of it
+# (e.g. "Hip-Hop/Rap" with " / ") survive the round trip. Every category column in the CSV is included, with an empty
+# list if its cell is empty; categories without a column are left out.
+def iter_tags_csv(csv_path, categories, delimiter):
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            if not row.get('path'):
+                continue
+            categorized_tags = {}
+            for category in categories:
+                cell = row.get(category)
+                if cell is not None:
+                    categorized_tags[category] = [tag.strip() for tag in cell.split(delimiter) if tag.strip()] if cell.strip() else []
+            yield row['path'], categorized_tags
+
+# Function to apply an edited tag export to file metadata, the MyTag database and the Rekordbox collections in one
+# batched pass, with the same writers as a normal run. Returns the number of files whose metadata was rewritten.
+def import_tags(csv_path, mytag_db_file, rekordbox_db_path, categories, delimiter, use_rekordbox_xml, checkpoint_interval=0, workers=1, log=print,
+                db_format='xml', spill_threshold=10000):
+    categories = categories.categories if isinstance(categories, Categorizer) else categories
+    database = open_mytag_database(mytag_db_file, checkpoint_interval, db_format)
+    collection = RekordboxCollection(rekordbox_db_path, spill_threshold) if use_rekordbox_xml else None
+
+    # A category whose cell was emptied removes its metadata field and empties its TRACK attribute, so the old tags do
+    # not survive in the file or the collection
+    def with_cleared_fields(values, categorized_tags, field_key, cleared):
+        for category, tags in categorized_tags.items():
+            field = categories[category].get(field_key)
+            if field and not tags:
+                values.setdefault(field, cleared)
+        return values
+
+    def work(row):
+        file_path, categorized_tags = row
+        if not (os.path.exists(file_path) and file_path.lower().endswith(('.flac', '.mp3'))):
+            return file_path, categorized_tags, None
+        values = with_cleared_fields(build_metadata_values(categorized_tags, categories, delimiter), categorized_tags, 'metadata_field', None)
+        return file_path, categorized_tags, write_metadata_values(file_path, values)
+
+    imported = files_written = missing = 0
+    for file_path, categorized_tags, bytes_written in ordered_map(work, iter_tags_csv(csv_path, categories, delimiter), workers):
+        if bytes_written is None:
+            missing += 1
+            continue
+        imported += 1
+        files_written += bool(bytes_written)
+        database.update_song(file_path, categorized_tags, categories, replace=True)
+        if collection is not None:
+            attributes = build_rekordbox_attributes(categorized_tags, categories, delimiter)
+            collection.stage(file_path, with_cleared_fields(attributes, categorized_tags, 'rekordbox_field', ''))
+
+    database.close()
+    log(f"Tags imported for {imported} files ({files_written} files written, {missing} missing or unsupported)")
+    if collection is not None:
+        updated_tracks = collection.commit()
+        collection.log_commit(updated_tracks, log)
+    return files_written
+
+# The process umask, read once at import while no other threads are creating files (os.umask can only be read by setting it)
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Function to write a file atomically: write_func fills a temp file in the same directory, which is then renamed over the target
+def write_file_atomic(path, write_func):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_func(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)  # Keep the permissions of the file being replaced
+        else:
+            os.chmod(tmp_path, 0o666 & ~UMASK)  # mkstemp creates owner-only files; give new files the usual permissions
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Function to write an XML tree to disk atomically
+def write_xml_atomic(tree, path):
+    write_file_atomic(path, lambda f: tree.write(f, encoding="utf-8", xml_declaration=True))
+
+# Function to write JSON data to disk atomically
+def write_json_atomic(data, path):
+    write_file_atomic(path, lambda f: f.write(json.dumps(data, indent=1).encode('utf-8')))
+
+# Function to turn a Rekordbox TRACK Location attribute into a file path
+def location_to_path(location):
+    # Locations are file URLs: file://localhost/C:/Music/a%20b.mp3 on Windows, file://localhost/Users/me/a%20b.mp3 on macOS
+    parts = urlsplit(location)
+    if parts.scheme.lower() != 'file':
+        return unquote(location)
+    path = unquote(parts.path)
+    if parts.netloc and parts.netloc.lower() != 'localhost':
+        return f"//{parts.netloc}{path}"  # Network share (UNC path)
+    if re.match(r'^/[A-Za-z]:', path):
+        return path[1:]  # Drop the slash in front of a Windows drive letter
+    return path
+
+# Function to build the TRACK attribute values for a file from its categorized tags
+def build_rekordbox_attributes(categorized_tags, categories, delimiter):
+    attributes = {}
+    for category, category_info in categories.items():
+        rekordbox_field = category_info.get('rekordbox_field')
+        if rekordbox_field:
+            tags = categorized_tags.get(category, [])
+            if tags:
+                attributes[rekordbox_field] = delimiter.join(tags)
+    return attributes
+
+# Characters escaped in attribute values on top of &, < and >, the same ones ElementTree escapes
+XML_ATTRIBUTE_ENTITIES = {'"': '&quot;', '\r': '&#13;', '\n': '&#10;', '\t': '&#09;'}
+
+# Function to escape &, < and > (and any extra entities) in XML text
+def escape(text, entities={}):
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    for character, entity in entities.items():
+        text = text.replace(character, entity)
+    return text
+
+class RekordboxCollection:
+    """Rekordbox collection XML that is streamed once at commit time, applying every staged TRACK update on the way.
+
+    rekordbox_db_path can also be a list of collections that share files; every update is staged once and written
+    to each collection that has a TRACK for the file. Staged updates are kept in memory until there are
+    spill_threshold of them; after that they are moved to a temporary SQLite file next to the first collection, so
+    neither the staged updates nor the collections themselves have to fit in memory.
+    """
+
+    def __init__(self, rekordbox_db_path, spill_threshold=10000):
+        self.paths = collection_paths(rekordbox_db_path)
+        self.path = self.paths[0]
+        self.spill_threshold = spill_threshold  # Staged files kept in memory before spilling to disk (0 = never spill)
+        self.pending = {}  # file path -> {TRACK attribute: value}
+        self.spill = None  # SQLite connection holding the spilled updates
+        self.spill_path = None
+        self.timings = {}
+        self.updated_tracks = {}  # Collection path -> TRACK elements updated by the last commit
+
+    def stage(self, file_path, attributes):
+        """Queue TRACK attribute updates for a file until the collection is committed."""
+        if attributes:
+            self.pending.setdefault(file_path, {}).update(attributes)
+            if self.spill_threshold and len(self.pending) >= self.spill_threshold:
+                self.spill_pending()
+
+    def spill_pending(self):
+        """Move the staged updates held in memory to the spill file, merging them with ones spilled earlier."""
+        start = time.perf_counter()
+        if self.spill is None:
+            fd, self.spill_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.path)}.", suffix=".staged", dir=os.path.dirname(os.path.abspath(self.path)))
+            os.close(fd)
+            self.spill = sqlite3.connect(self.spill_path)
+            self.spill.execute("CREATE TABLE staged (file_path TEXT PRIMARY KEY, attributes TEXT NOT NULL)")
+        with self.spill:
+            for file_path, attributes in self.pending.items():
+                row = self.spill.execute("SELECT attributes FROM staged WHERE file_path = ?", (file_path,)).fetchone()
+                if row is not None:
+                    attributes = {**json.loads(row[0]), **attributes}
+                self.spill.execute("INSERT OR REPLACE INTO staged (file_path, attributes) VALUES (?, ?)", (file_path, json.dumps(attributes)))
+        self.pending.clear()
+        self.timings['spill'] = self.timings.get('spill', 0.0) + time.perf_counter() - start
+
+    def staged_attributes(self, file_path):
+        """Return the staged updates for a file, or None if there are none."""
+        attributes = self.pending.get(file_path)
+        if self.spill is not None:
+            row = self.spill.execute("SELECT attributes FROM staged WHERE file_path = ?", (file_path,)).fetchone()
+            if row is not None:
+                attributes = {**json.loads(row[0]), **(attributes or {})}
+        return attributes
+
+    def discard_spill(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.remove(self.spill_path)
+            self.spill = self.spill_path = None
+
+    def commit(self):
+        """Stream each collection through a Location lookup of the staged updates and write it back once."""
+        timings = {'spill': self.timings['spill']} if 'spill' in self.timings else {}
+        self.timings = timings
+        self.updated_tracks = {}
+        if not self.pending and self.spill is None:
+            return 0
+
+        # The collections are parsed, updated and written in one streaming pass, so parse and apply are measured as
+        # they happen and write is whatever is left: serializing the elements and replacing the files
+        start = time.perf_counter()
+        self.timings.update(parse=0.0, apply=0.0)
+        try:
+            for path in self.paths:
+                self.updated_tracks[path] = self.rewrite(path)
+        finally:
+            self.discard_spill()
+            self.pending.clear()
+        self.timings['write'] = time.perf_counter() - start - self.timings['parse'] - self.timings['apply']
+        return sum(self.updated_tracks.values())
+
+    def parse_events(self, path):
+        """Yield the start and end events of ET.iterparse, adding the time spent parsing to the 'parse' timing."""
+        events = ET.iterparse(path, events=('start', 'end'))
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            try:
+                item = next(events)
+            except StopIteration:
+                return
+            finally:
+                self.timings['parse'] += clock() - start
+            yield item
+
+    def rewrite(self, path):
+        """Stream one collection file, applying the staged updates, and replace it atomically."""
+        updated = 0
+
+        def write(f):
+            nonlocal updated
+            # Elements are written as soon as their start tag has been parsed, then cleared and detached from their
+            # parent once they end, so memory use does not depend on the size of the collection. The output is the
+            # same as ET.indent(tree, '  ') followed by tree.write(); Rekordbox collections have no mixed content,
+            # so only the text of elements without children is kept.
+            out = io.TextIOWrapper(f, encoding='utf-8', newline='\n')
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            parents = []  # [element, has child elements]
+            open_tag = False  # The last start tag still needs its closing '>' or ' />'
+            for event, element in self.parse_events(path):
+                if event == 'start':
+                    attributes = dict(element.attrib)
+                    if element.tag == "TRACK" and attributes.get("Location"):
+                        apply_start = time.perf_counter()
+                        staged = self.staged_attributes(location_to_path(attributes["Location"]))
+                        if staged:
+                            attributes.update(staged)
+                            updated += 1
+                        self.timings['apply'] += time.perf_counter() - apply_start
+                    if parents:
+                        parent = parents[-1]
+                        if open_tag:
+                            out.write(">")
+                        if not parent[1] and parent[0].text and parent[0].text.strip():
+                            out.write(escape(parent[0].text))
+                        parent[1] = True
+                        out.write("\n" + "  " * len(parents))
+                    out.write(f"<{element.tag}" + "".join(f' {name}="{escape(value, XML_ATTRIBUTE_ENTITIES)}"' for name, value in attributes.items()))
+                    open_tag = True
+                    parents.append([element, False])
+                    continue
+
+                _, has_children = parents.pop()
+                if has_children:
+                    out.write("\n" + "  " * len(parents) + f"</{element.tag}>")
+                elif element.text and element.text.strip():
+                    out.write(f">{escape(element.text)}</{element.tag}>")
                 else:
-                    flattened_comments.append(comment)  # Otherwise, just append it as-is
-
-            # Categorize the tags from the comments
-            categorized_tags = process_comments(flattened_comments, categories)
-
-            # Check if the file path already exists in the XML
-            for song in root.findall("Song"):
-                if song.find("FilePath").text == file_path:
-                    file_element = song
-                    break
-
-            if file_element is None:
-                # If the file is not in the XML, add a new Song element
-                file_element = ET.SubElement(root, "Song")
-                file_path_element = ET.SubElement(file_element, "FilePath")
-                file_path_element.text = file_path
-
-            # Now, update the tags under each category in the XML
-            for category, category_info in categories.items():
-                category_element = file_element.find(category)
-                if category_element is None:
-                    category_element = ET.SubElement(file_element, category)
-
-                # Add tags to the category element if not already present
-                existing_tags = {tag_element.text for tag_element in category_element.findall("Tag")}
-                for tag in categorized_tags.get(category, []):
-                    if tag not in existing_tags:
-                        tag_element = ET.SubElement(category_element, "Tag")
-                        tag_element.text = tag
-
-            # Write the updated XML back to the file
-            ET.indent(tree, '  ')
-            tree.write(mytag_db_file, encoding="utf-8", xml_declaration=True)
-
-            # Now, update the metadata field in the FLAC or MP3 file
-            if file_path.lower().endswith('.flac'):
-                update_metadata_flac(file_path, categorized_tags, categories, delimiter)
-            elif file_path.lower().endswith('.mp3'):
-                update_metadata_mp3(file_path, categorized_tags, categories, delimiter)
-            
-            if use_rekordbox_xml:
-                update_track_in_xml(rekordbox_db_path, file_path, categorized_tags, categories, delimiter) # After updating the FLAC or MP3 metadata, write the tags back to the the songs TRACK element in the original Rekordbox XML if use_rekordbox_xml is enabled
-           
+                    out.write(" />")
+                open_tag = False
+                element.clear()
+                if parents:
+                    parents[-1][0].remove(element)
+            out.flush()
+            out.detach()
+
+        write_file_atomic(path, write)
+        return updated
+
+    def read_attributes(self, fields):
+        """Stream the collections and return {file path: {field: current value}} for the given TRACK attributes.
 
-# Function to update the TRACK tags in the original XML database
+        A file in several collections gets the values from the first collection that has it.
+        """
+        current = {}
+        for path in self.paths:
+            for event, element in ET.iterparse(path, events=('end',)):
+                if element.tag == "TRACK":
+                    location = element.get("Location")
+                    if location:
+                        current.setdefault(location_to_path(location), {field: element.get(field) for field in fields})
+                    element.clear()
+        return current
+
+    def describe_timings(self):
+        """Return a one-line summary of how long each commit phase took."""
+        return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.timings.items())
+
+    def log_commit(self, updated_tracks, log=print):
+        """Log the result of commit(), with a line per collection when there are several."""
+        if not self.timings:
+            return
+        log(f'Rekordbox XML updated: {updated_tracks} tracks ({self.describe_timings()})')
+        if len(self.paths) > 1:
+            for path, count in self.updated_tracks.items():
+                log(f'  {path}: {count} tracks')
+
+# Function to update the TRACK tags in the original XML database for a single file
 def update_track_in_xml(rekordbox_db_path, file_path, categorized_tags, categories, delimiter):
-    # Parse the XML database
-    tree = ET.parse(rekordbox_db_path)
-    root = tree.getroot()
-
-    # Find the TRACK element that corresponds to the given FLAC or MP3 file
-    for track in root.iter("TRACK"):
-        location = track.get("Location")
-        if location and location == f"file://localhost/{file_path.replace(' ', '%20')}":
-            # For each category, update the corresponding tags
-            for category, category_info in categories.items():
-                rekordbox_field = category_info.get('rekordbox_field')
-                if rekordbox_field:
-                    # Prepare tags as a string separated by "; "
-                    tags = categorized_tags.get(category, [])
-                    if tags:
-                        # Set the tags as an attribute in the TRACK element
-                        track.set(rekordbox_field, delimiter.join(tags))
-
-            # Write the updated XML back to the database file
-            ET.indent(tree, '  ')
-            tree.write(rekordbox_db_path, encoding="utf-8", xml_declaration=True)
-
-# Main function to load config and start the process
-def main():
-    config_file = 'config.json'  # Path to your config file
+    collection = RekordboxCollection(rekordbox_db_path)
+    collection.stage(file_path, build_rekordbox_attributes(categorized_tags, categories, delimiter))
+    collection.commit()
 
-    # Load the categories, XML database path, and XML output path from the config file
-    config = load_config(config_file)
+# Function to pick the files to process from the config: a stream of paths from the Rekordbox XML or the music directory.
+# Returns (file_paths, total), where total is None if it is not known up front, or None if the configured source is invalid.
+def resolve_file_source(config, log=print):
+    use_rekordbox_xml = config.get('use_rekordbox_xml')
+    # Check if XML database path is provided and valid
+    rekordbox_db_path = config.get('rekordbox_db_path')  # Path to the XML database
+    music_directory = config.get('music_directory')
+    if use_rekordbox_xml:
+        rekordbox_db_paths = collection_paths(rekordbox_db_path)
+        missing = [path for path in rekordbox_db_paths if not os.path.exists(path)]
+        if not rekordbox_db_paths or missing:
+            log(f"Invalid or missing XML database file: {', '.join(missing) or rekordbox_db_path}")
+            return None
+        # Stream file paths from the XML databases so processing starts straight away. With several collections the
+        # number of distinct files is only known at the end.
+        total = count_tracks_in_xml(rekordbox_db_paths[0]) if len(rekordbox_db_paths) == 1 else None
+        return iter_file_paths_from_xmls(rekordbox_db_paths), total
+    elif music_directory and os.path.exists(music_directory):
+        # Stream file paths from the specified directory; the total is not known until the scan is done
+        return iter(DirectoryScanner.from_config(config)), None
+    log(f"Invalid or missing music directory path: {music_directory}")
+    return None
+
+# Function to run the converter in-process with the settings from a config dict. progress_callback is called after
+# every file with (done, total, file_path, files_per_second), where total is None if it is not known up front.
+# Setting cancel_event stops the run after the current file. Returns the run summary, or None if there is nothing to
+# process. With 'dry_run' set, nothing is written except the change plan at 'plan_file'. The config must already have
+# been checked with validate_config (load_config does this), which also fills in the defaults.
+def run(config, progress_callback=None, cancel_event=None, log=print):
     mytag_db_file = config.get('mytag_db_file')  # Get XML output file path
-    categories = config.get('categories')  # Get categories from config
+    categories = Categorizer.from_config(config)  # Compile the tag lookup table from the categories in the config
     use_rekordbox_xml = config.get('use_rekordbox_xml')
     delimiter = str(config.get('tag_delimiter'))
-    # Check if XML database path is provided and valid
     rekordbox_db_path = config.get('rekordbox_db_path')  # Path to the XML database
+    checkpoint_interval = int(config.get('mytag_checkpoint_interval', 1000))  # Songs between MyTag database checkpoints
+    workers = int(config.get('workers', 1))  # 1 = process files one at a time
+    force_rescan = bool(config.get('force_rescan', False))
+    profile_dump = config.get('profile_dump')  # Optional cProfile/pstats output file
+    profile = RunProfile(enabled=bool(config.get('profile', False)) or bool(profile_dump))
+    db_format = config.get('mytag_db_format')  # 'xml' or 'sqlite'
+
+    with profile.phase('scan'):
+        source = resolve_file_source(config, log)
+    if source is None:
+        return None
+    file_paths, total = source
+
+    if config.get('dry_run'):
+        plan_path = config.get('plan_file') or 'mytag_plan.json'
+        plan = plan_update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml, workers, force_rescan,
+                               progress_callback=progress_callback, cancel_event=cancel_event, total=total)
+        save_plan(plan, plan_path)
+        changes = sum(len(entry['changes']) for entry in plan['files'])
+        log(f"Dry run: {len(plan['files'])} of {plan['files_checked']} files would change ({changes} fields). Plan written to {plan_path}")
+        return plan
+
+    # cProfile only sees the thread it was enabled on, so worker threads are not included in the dump
+    profiler = cProfile.Profile() if profile_dump else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        # Process the FLAC and MP3 files and update the XML
+        summary = update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml, checkpoint_interval, workers, force_rescan,
+                             progress_callback=progress_callback, cancel_event=cancel_event, total=total, log=log, profile=profile,
+                             db_format=db_format, queue_size=int(config.get('pipeline_queue_size', 256)),
+                             spill_threshold=int(config.get('collection_spill_threshold', 10000)), resume=bool(config.get('resume', False)))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_dump)
+            log(f"cProfile stats written to {profile_dump}" + (" (main thread only)" if workers > 1 else ""))
+    log(f'File metadata updated and MyTag Db generated: {mytag_db_file}')
+    return summary
+
+# inotify(7) event flags used by the watcher
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, length of the name that follows
+
+class FileWatcher:
+    """Reports the files that were written below a set of directories, through inotify on Linux or by comparing
+    file sizes and mtimes every poll_interval seconds elsewhere.
+
+    directories maps each directory to whether its sub directories are watched as well. wait() returns the set of
+    changed file paths, or None if events were lost and everything has to be checked again. Directories inotify
+    cannot watch (e.g. once fs.inotify.max_user_watches is used up) are polled instead, with a warning.
+    """
+
+    def __init__(self, directories, poll_interval=5.0, use_inotify=True, log=print):
+        self.directories = {}
+        self.poll_interval = poll_interval
+        self.log = log
+        self.snapshot = {}
+        self.next_poll = 0.0
+        self.fd = None
+        self.watches = {}  # inotify watch descriptor -> (directory, recursive)
+        self.polled = {}  # Directories inotify failed to watch -> False (each one is polled on its own)
+        if use_inotify:
+            self.libc = self.load_inotify()
+            if self.libc is not None:
+                self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+                if self.fd < 0:
+                    self.fd = None
+        for directory, recursive in directories.items():
+            self.add(directory, recursive)
+        self.next_poll = time.monotonic() + poll_interval
+
+    @staticmethod
+    def load_inotify():
+        """Return libc with the inotify functions set up through ctypes, or None where inotify is not available."""
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (ImportError, OSError, AttributeError):
+            return None
+        return libc
+
+    @property
+    def mode(self):
+        if self.fd is None:
+            return 'polling'
+        return f'inotify, {len(self.polled)} polled' if self.polled else 'inotify'
+
+    def add(self, directory, recursive=False):
+        """Start watching a directory (and its sub directories if recursive); returns the files already in it."""
+        directory = os.path.abspath(directory)
+        if directory in self.directories and (self.directories[directory] or not recursive):
+            return []
+        self.directories[directory] = recursive
+        files = []
+        failed, error_code = 0, 0
+        for path, sub_directories, names in (os.walk(directory) if recursive else [(directory, [], self.list_files(directory))]):
+            paths = [os.path.join(path, name) for name in names]
+            if self.fd is not None:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                if wd >= 0:
+                    self.watches[wd] = (path, recursive)
+                else:
+                    import ctypes
+                    failed, error_code = failed + 1, ctypes.get_errno()
+                    self.polled[path] = False
+            if self.fd is None or path in self.polled:
+                for file_path in paths:
+                    self.snapshot[file_path] = self.stat(file_path)
+            files.extend(paths)
+        if failed:
+            self.log(f"Warning: could not watch {failed} director{'ies' if failed != 1 else 'y'} with inotify ({os.strerror(error_code)}), "
+                     f"checking {'them' if failed != 1 else 'it'} every {self.poll_interval:g}s instead"
+                     + (". Raise fs.inotify.max_user_watches to watch everything with inotify" if error_code == errno.ENOSPC else ""))
+        return files
+
+    @staticmethod
+    def list_files(directory):
+        try:
+            with os.scandir(directory) as entries:
+                return [entry.name for entry in entries if entry.is_file()]
+        except OSError:
+            return []
+
+    @staticmethod
+    def stat(file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds and return the files written since the last call."""
+        if self.fd is None:
+            remaining = self.next_poll - time.monotonic()
+            if remaining > 0:
+                time.sleep(min(timeout, remaining))
+                return set()
+            self.next_poll = time.monotonic() + self.poll_interval
+            return self.poll()
+
+        changed = self.read_events(timeout)
+        # Directories inotify could not watch are polled alongside the events
+        if self.polled and changed is not None and time.monotonic() >= self.next_poll:
+            self.next_poll = time.monotonic() + self.poll_interval
+            changed |= self.poll()
+        return changed
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds for inotify events and return the files they report as written."""
+        import select
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0'))
+                offset += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if wd not in self.watches or not name:
+                    continue
+                directory, recursive = self.watches[wd]
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    # A new or moved in sub directory is watched as well, and the files it already holds count as changed
+                    if recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                        self.directories.pop(path, None)
+                        changed.update(self.add(path, True))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changed.add(path)
+
+    def poll(self):
+        """Compare the size and mtime of every file below the polled directories with the previous poll."""
+        changed = set()
+        snapshot = {}
+        for directory, recursive in (self.directories if self.fd is None else self.polled).items():
+            for path, _, names in (os.walk(directory) if recursive else [(directory, [], self.list_files(directory))]):
+                for name in names:
+                    file_path = os.path.join(path, name)
+                    if file_path in snapshot:
+                        continue
+                    snapshot[file_path] = self.stat(file_path)
+                    if snapshot[file_path] != self.snapshot.get(file_path):
+                        changed.add(file_path)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# Function to keep running and process only the files that change, until cancel_event is set. Files written in a burst
+# (e.g. Rekordbox saving the MyTags of several tracks) are collected until nothing has changed for debounce seconds and
+# then go through the normal pipeline as one batch, so the MyTag database and the Rekordbox XML are written once per
+# batch. In Rekordbox XML mode the files of the collection are watched and a new export adds its new tracks. Like
+# run, it expects a config checked with validate_config.
+def watch(config, cancel_event=None, log=print, debounce=2.0, poll_interval=5.0, progress_callback=None):
+    cancel_event = cancel_event or threading.Event()
+    mytag_db_file = config.get('mytag_db_file')
+    categories = Categorizer.from_config(config)
+    use_rekordbox_xml = config.get('use_rekordbox_xml')
+    delimiter = str(config.get('tag_delimiter'))
+    rekordbox_db_path = config.get('rekordbox_db_path')
+    rekordbox_db_paths = [os.path.abspath(path) for path in collection_paths(rekordbox_db_path)] if use_rekordbox_xml else []
     music_directory = config.get('music_directory')
+    if resolve_file_source(config, log) is None:
+        return None
+
+    # Events carry absolute paths; tracks maps them back to the paths the MyTag database knows the files by
+    directories = {os.path.dirname(path): False for path in rekordbox_db_paths}
+    tracks = {}
     if use_rekordbox_xml:
-        if not rekordbox_db_path or not os.path.exists(rekordbox_db_path):
-            print(f"Invalid or missing XML database file: {rekordbox_db_path}")
-            return
-        else:
-            file_paths = extract_file_paths_from_xml(rekordbox_db_path) # Extract file paths from the XML database
-    elif not use_rekordbox_xml and os.path.exists(music_directory):
-        file_paths = get_file_paths_from_directory(music_directory) # Extract file paths from the specified directory
+        tracks = {os.path.abspath(file_path): file_path for file_path in iter_file_paths_from_xmls(rekordbox_db_paths)}
+        directories.update((os.path.dirname(file_path), False) for file_path in tracks)
+        scanner = None
     else:
-        print(f"Invalid or missing music directory path: {music_directory}")
-        return
+        scanner = DirectoryScanner.from_config(config)
+        scanner.root = os.path.abspath(music_directory)
+        directories[scanner.root] = True
+    watcher = FileWatcher(directories, poll_interval, log=log)
+    log(f"Watching {len(watcher.directories)} directories for changes ({watcher.mode})")
+
+    summary = {'batches': 0, 'files': 0}
+    pending = set()
+    rescan = False
+    last_change = None
+    written = {}  # Size and mtime of the files of the last batch once it was done, to ignore the events of our own writes
+    try:
+        while not cancel_event.is_set():
+            changed = watcher.wait(0.5)
+            if changed is None:
+                rescan = True
+                last_change = time.monotonic()
+            elif changed:
+                pending |= changed
+                last_change = time.monotonic()
+            if not (pending or rescan) or time.monotonic() - last_change < debounce:
+                continue
+
+            # A new export of the collection adds its new tracks to the batch and their directories to the watch
+            batch = set()
+            if any(path in pending for path in rekordbox_db_paths):
+                exported = {os.path.abspath(file_path): file_path for file_path in iter_file_paths_from_xmls(rekordbox_db_paths)}
+                for file_path in exported.keys() - tracks.keys():
+                    watcher.add(os.path.dirname(file_path))
+                    batch.add(exported[file_path])
+                tracks = exported
+            for file_path in pending:
+                if file_path in written and written[file_path] == watcher.stat(file_path):
+                    continue
+                if use_rekordbox_xml:
+                    if file_path in tracks:
+                        batch.add(tracks[file_path])
+                elif scanner.matches(file_path):
+                    batch.add(os.path.join(music_directory, os.path.relpath(file_path, scanner.root)))
+            pending = set()
+
+            if rescan:
+                log("Some changes were missed, checking every file")
+                source = resolve_file_source(config, log)
+                file_paths = source[0] if source is not None else []
+                rescan = False
+            elif batch:
+                log(f"{len(batch)} changed file{'s' if len(batch) != 1 else ''}: " + ", ".join(sorted(os.path.basename(path) for path in batch)[:5])
+                    + (", ..." if len(batch) > 5 else ""))
+                file_paths = sorted(batch)
+            else:
+                continue
+            # A failed batch (e.g. a file that was deleted while it was read) is reported and watching carries on
+            try:
+                result = update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml,
+                                    int(config.get('mytag_checkpoint_interval', 1000)), int(config.get('workers', 1)),
+                                    progress_callback=progress_callback, cancel_event=cancel_event, log=log,
+                                    db_format=config.get('mytag_db_format'), queue_size=int(config.get('pipeline_queue_size', 256)),
+                                    spill_threshold=int(config.get('collection_spill_threshold', 10000)))
+            except Exception as e:
+                log(f"Error: {type(e).__name__}: {e}")
+                continue
+            written = {os.path.abspath(file_path): watcher.stat(file_path) for file_path in batch}
+            summary['batches'] += 1
+            summary['files'] += result['new'] + result['updated']
+    finally:
+        watcher.close()
+    log(f"Stopped watching after {summary['batches']} batches ({summary['files']} files updated)")
+    return summary
+
+# Exit codes of the command line
+EXIT_OK = 0
+EXIT_ERROR = 1  # The run failed part way
+EXIT_INVALID_CONFIG = 2  # Bad arguments, config file or paths; nothing was done
+EXIT_CANCELLED = 130  # Stopped by Ctrl+C or SIGTERM after saving the files finished so far
+
+class JsonProgress:
+    """Writes a run's log lines, progress and summary as newline-delimited JSON events, one object per line."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def event(self, event, **data):
+        with self.lock:
+            # Escaped to ASCII so the events can be written to any stdout encoding (e.g. a cp1252 pipe on Windows)
+            self.stream.write(json.dumps({'event': event, 'time': round(time.time(), 3), **data}) + '\n')
+            self.stream.flush()
+
+    def log(self, message):
+        self.event('log', message=str(message))
+
+    def progress(self, done, total, file_path, files_per_second):
+        self.event('progress', done=done, total=total, file=file_path, files_per_second=round(files_per_second, 2))
+
+# Function to stop the run gracefully on the first Ctrl+C or SIGTERM; a second Ctrl+C stops straight away
+def install_cancel_handlers(cancel_event):
+    def handle(signum, frame):
+        if cancel_event.is_set() and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        cancel_event.set()
 
-    # Process the FLAC and MP3 files and update the XML
-    update_xml(mytag_db_file, rekordbox_db_path, file_paths, categories, delimiter, use_rekordbox_xml)
-    print(f'File metadata updated and MyTag Db generated: {mytag_db_file}')
+    signal.signal(signal.SIGINT, handle)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, handle)
+
+# Options that run a single command instead of the converter, in the order they are checked
+COMMANDS = ('apply_plan', 'rollback_report', 'export_tags', 'import_tags', 'query_tag', 'export_xml')
+
+# Function to run the command selected on the command line (one of COMMANDS) and return its summary. Bad input
+# (missing files, invalid plans or paths) raises FileNotFoundError, ConfigError or ValueError.
+def run_command(args, config, log=print, reporter=None):
+    if args.apply_plan:
+        files_written = apply_plan(load_plan(args.apply_plan), config.get('mytag_db_file'), config.get('rekordbox_db_path'),
+                                   config.get('categories') or {}, config.get('use_rekordbox_xml'), int(config.get('mytag_checkpoint_interval', 1000)),
+                                   int(config.get('workers', 1)), log=log, db_format=config.get('mytag_db_format'))
+        return {'files_written': files_written}
+
+    if args.rollback_report:
+        # Runs that changed nothing are skipped, so the report undoes the last run that did
+        journal_path = RunJournal.path_for(config.get('mytag_db_file'))
+        journal_path = RunJournal.latest_with_changes(journal_path) or journal_path
+        if not os.path.exists(journal_path):
+            raise FileNotFoundError(f"No run journal found at {journal_path}")
+        report = rollback_report(journal_path)
+        save_plan(report, args.rollback_report)
+        state = "finished" if report['finished'] else "did not finish"
+        log(f"The run started {report['run']} {state} and modified {len(report['files'])} files. Rollback plan written to {args.rollback_report}")
+        return {'files': len(report['files']), 'run_finished': report['finished'], 'plan_file': args.rollback_report}
+
+    if args.export_tags:
+        categories = config.get('categories') or {}
+        if args.export_from == 'files':
+            if resolve_file_source(config, log) is None:
+                raise ConfigError("nothing to export, check the paths in the config")
+
+            # Every call starts a new scan, so the rows can be iterated more than once
+            def rows():
+                return iter_categorized_files(resolve_file_source(config, log)[0], Categorizer.from_config(config), int(config.get('workers', 1)))
+
+            count = export_tags(rows, categories, args.export_tags, str(config.get('tag_delimiter')), log)
+        else:
+            database = open_mytag_database(config.get('mytag_db_file'), db_format=config.get('mytag_db_format'))
+            try:
+                count = export_tags(database.iter_songs, categories, args.export_tags, str(config.get('tag_delimiter')), log)
+            finally:
+                database.close()
+        return {'files_exported': count}
+
+    if args.import_tags:
+        files_written = import_tags(args.import_tags, config.get('mytag_db_file'), config.get('rekordbox_db_path'), config.get('categories') or {},
+                                    str(config.get('tag_delimiter')), config.get('use_rekordbox_xml'), int(config.get('mytag_checkpoint_interval', 1000)),
+                                    int(config.get('workers', 1)), log=log, db_format=config.get('mytag_db_format'),
+                                    spill_threshold=int(config.get('collection_spill_threshold', 10000)))
+        return {'files_written': files_written}
+
+    summary = {}
+    database = open_mytag_database(config.get('mytag_db_file'), db_format=config.get('mytag_db_format'))
+    try:
+        if args.query_tag:
+            # Matches are printed one per line, or sent as 'match' events so they do not break the JSON stream
+            matches = 0
+            for file_path in database.songs_with_tag(args.query_tag, args.query_category):
+                if reporter is not None:
+                    reporter.event('match', file=file_path)
+                else:
+                    print(file_path)
+                matches += 1
+            summary['matches'] = matches
+        if args.export_xml:
+            database.export_xml(args.export_xml)
+            log(f"MyTag database exported to {args.export_xml}")
+            summary['export_xml'] = args.export_xml
+    finally:
+        database.close()
+    return summary
+
+# Main function to load config and start the process; returns the exit code
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Categorize Rekordbox MyTags and write them to file metadata.",
+                                     epilog="Exit codes: 0 success, 1 the run failed, 2 invalid arguments or config, 130 cancelled.")
+    parser.add_argument('--config', default='config.json', help="Path to the config file (default: config.json)")
+    parser.add_argument('--source', choices=('xml', 'directory'),
+                        help="Read the files to process from the Rekordbox XML or the music directory (overrides 'use_rekordbox_xml')")
+    parser.add_argument('--music-directory', metavar='PATH', help="Music directory to scan (overrides 'music_directory')")
+    parser.add_argument('--workers', type=int, help="Number of files to process in parallel (overrides the 'workers' config key)")
+    parser.add_argument('--force-rescan', action='store_true', help="Process every file, even ones that have not changed since the last run")
+    parser.add_argument('--resume', action='store_true', help="Continue an interrupted run from its journal instead of starting over")
+    parser.add_argument('--rollback-report', metavar='PATH',
+                        help="Write the metadata changes of the last run, from its journal, as a plan that undoes them (apply with --apply-plan), then exit")
+    parser.add_argument('--progress', choices=('text', 'jsonl'), default='text',
+                        help="text: print the run log (default); jsonl: write newline-delimited JSON events to stdout, ending with a summary")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running and process files as they change (inotify on Linux, polling elsewhere) until Ctrl+C or SIGTERM")
+    parser.add_argument('--watch-debounce', type=float, default=2.0, metavar='SECONDS',
+                        help="Wait until nothing has changed for this long before processing a batch of changes (default: 2)")
+    parser.add_argument('--watch-interval', type=float, default=5.0, metavar='SECONDS',
+                        help="How often to check the files for changes when inotify is not available (default: 5)")
+    parser.add_argument('--profile', action='store_true', help="Print how long each phase of the run took")
+    parser.add_argument('--profile-dump', metavar='PATH', help="Also write cProfile stats to PATH (readable with pstats)")
+    parser.add_argument('--dry-run', action='store_true', help="Write the changes a run would make to the config's 'plan_file' without touching any file")
+    parser.add_argument('--plan', metavar='PATH', help="Dry run: write the changes a run would make to PATH (.json or .csv) without touching any file")
+    parser.add_argument('--apply-plan', metavar='PATH', help="Apply a plan saved with --plan, writing only the files and fields listed in it")
+    parser.add_argument('--collection', metavar='PATH', action='append',
+                        help="Rekordbox collection XML to read and update; repeat to process several collections in one run (overrides 'rekordbox_db_path')")
+    parser.add_argument('--query-tag', metavar='TAG', help="Print the files in the MyTag database that have TAG, then exit")
+    parser.add_argument('--query-category', metavar='CATEGORY', help="Only match --query-tag in this category")
+    parser.add_argument('--export-xml', metavar='PATH', help="Export the MyTag database to PATH in the MyTags XML format, then exit")
+    parser.add_argument('--export-tags', metavar='PATH', help="Export the categorized tags to PATH (.csv, .jsonl, .parquet or columnar .json), then exit")
+    parser.add_argument('--export-from', choices=('database', 'files'), default='database',
+                        help="Export the tags stored in the MyTag database (default) or categorize the source files again without writing them")
+    parser.add_argument('--import-tags', metavar='PATH',
+                        help="Apply an edited --export-tags CSV to the file metadata, MyTag database and Rekordbox XML, then exit")
+    args = parser.parse_args(argv)
+
+    reporter = JsonProgress(sys.stdout) if args.progress == 'jsonl' else None
+    log = reporter.log if reporter is not None else print
+
+    def fail(code, message):
+        if reporter is not None:
+            reporter.event('error', message=message, exit_code=code)
+        else:
+            print(message, file=sys.stderr)
+        return code
+
+    # Load the categories, XML database path, and XML output path from the config file
+    try:
+        config = load_config(args.config)
+    except FileNotFoundError:
+        return fail(EXIT_INVALID_CONFIG, f"Config file not found: {args.config}")
+    except ConfigError as e:
+        return fail(EXIT_INVALID_CONFIG, f"Invalid config: {e}")
+    if args.source:
+        config['use_rekordbox_xml'] = args.source == 'xml'
+    if args.music_directory:
+        config['music_directory'] = args.music_directory
+    if args.workers is not None:
+        config['workers'] = args.workers
+    if args.force_rescan:
+        config['force_rescan'] = True
+    if args.resume:
+        config['resume'] = True
+    if args.profile:
+        config['profile'] = True
+    if args.profile_dump:
+        config['profile_dump'] = args.profile_dump
+    if args.collection:
+        config['rekordbox_db_path'] = args.collection
+        config['use_rekordbox_xml'] = args.source != 'directory'
+    if args.dry_run:
+        config['dry_run'] = True
+    if args.plan:
+        config['dry_run'] = True
+        config['plan_file'] = args.plan
+    try:
+        config = validate_config(config)
+    except ConfigError as e:
+        return fail(EXIT_INVALID_CONFIG, f"Invalid config: {e}")
+
+    command = next((name for name in COMMANDS if getattr(args, name)), None)
+    if command is not None:
+        try:
+            summary = run_command(args, config, log, reporter)
+        except KeyboardInterrupt:
+            return fail(EXIT_CANCELLED, f"--{command.replace('_', '-')} interrupted")
+        except (FileNotFoundError, ConfigError, ValueError) as e:
+            return fail(EXIT_INVALID_CONFIG, f"--{command.replace('_', '-')} failed: {e}")
+        except Exception as e:
+            return fail(EXIT_ERROR, f"--{command.replace('_', '-')} failed: {type(e).__name__}: {e}")
+        if reporter is not None:
+            reporter.event('summary', exit_code=EXIT_OK, command=command, **summary)
+        return EXIT_OK
+
+    cancel_event = threading.Event()
+    install_cancel_handlers(cancel_event)
+    if args.watch:
+        if reporter is not None:
+            reporter.event('start', config=os.path.abspath(args.config), source='xml' if config.get('use_rekordbox_xml') else 'directory',
+                           watch=True, workers=int(config.get('workers', 1)))
+        try:
+            result = watch(config, cancel_event=cancel_event, log=log, debounce=args.watch_debounce, poll_interval=args.watch_interval,
+                           progress_callback=reporter.progress if reporter is not None else None)
+        except KeyboardInterrupt:
+            return fail(EXIT_CANCELLED, "Watch interrupted")
+        except ConfigError as e:
+            return fail(EXIT_INVALID_CONFIG, f"Invalid config: {e}")
+        except Exception as e:
+            return fail(EXIT_ERROR, f"Watch failed: {type(e).__name__}: {e}")
+        if result is None:
+            return fail(EXIT_INVALID_CONFIG, "Nothing to watch: check the paths in the config")
+        # Ctrl+C or SIGTERM is how watching normally ends
+        if reporter is not None:
+            reporter.event('summary', exit_code=EXIT_OK, **result)
+        return EXIT_OK
+
+    if reporter is not None:
+        reporter.event('start', config=os.path.abspath(args.config), source='xml' if config.get('use_rekordbox_xml') else 'directory',
+                       dry_run=bool(config.get('dry_run')), workers=int(config.get('workers', 1)))
+    try:
+        result = run(config, progress_callback=reporter.progress if reporter is not None else None, cancel_event=cancel_event, log=log)
+    except KeyboardInterrupt:
+        return fail(EXIT_CANCELLED, "Run interrupted")
+    except ConfigError as e:
+        return fail(EXIT_INVALID_CONFIG, f"Invalid config: {e}")
+    except Exception as e:
+        return fail(EXIT_ERROR, f"Run failed: {type(e).__name__}: {e}")
+    if result is None:
+        return fail(EXIT_INVALID_CONFIG, "Nothing was processed: check the paths in the config")
+
+    if config.get('dry_run'):
+        summary = {'dry_run': True, 'files_checked': result['files_checked'], 'files_changing': len(result['files']),
+                   'fields_changing': sum(len(entry['changes']) for entry in result['files']),
+                   'plan_file': config.get('plan_file') or 'mytag_plan.json', 'cancelled': bool(result.get('cancelled'))}
+    else:
+        summary = result
+    exit_code = EXIT_CANCELLED if summary.get('cancelled') else EXIT_OK
+    if reporter is not None:
+        reporter.event('summary', exit_code=exit_code, **summary)
+    return exit_code
 
 # Run the script
 if __name__ == '__main__':
-    main()
+    sys.exit(main())